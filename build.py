@@ -2,24 +2,99 @@
 # Copyright (c) 2012 Turbulenz Limited
 
 import os
+import sys
+
+def _trace_imports():
+    """Report the time taken by each following import on stderr, like 'python -X importtime'."""
+    import __builtin__
+    from time import time as _time
+    original_import = __builtin__.__import__
+    nested = [ ]
+
+    def _import(name, *args, **kwargs):
+        if name in sys.modules:
+            return original_import(name, *args, **kwargs)
+        nested.append(0.0)
+        start = _time()
+        try:
+            return original_import(name, *args, **kwargs)
+        finally:
+            cumulative = _time() - start
+            children = nested.pop()
+            if nested:
+                nested[-1] += cumulative
+            sys.stderr.write('import time: %9i | %10i | %s%s\n' % ((cumulative - children) * 1e6, cumulative * 1e6,
+                                                                  '  ' * len(nested), name))
+
+    sys.stderr.write('import time: self [us] | cumulative | imported package\n')
+    __builtin__.__import__ = _import
+
+if os.environ.get('TZBUILD_IMPORTTIME'):
+    _trace_imports()
+
+import re
 
 from glob import glob
+from fnmatch import fnmatch
 from platform import system, machine
 from subprocess import Popen, PIPE, STDOUT
 from os.path import join as path_join, isdir as path_isdir, splitext as path_splitext, exists as path_exists, \
     split as path_split, expanduser as path_expanduser, basename as path_basename, abspath as path_abspath
 
 from base64 import urlsafe_b64encode
-from hashlib import sha1
+from hashlib import md5
 from shutil import copyfile, rmtree
 from optparse import OptionParser
-from distutils.version import StrictVersion
 from logging import debug, info, warning, error, basicConfig as logging_config
-from threading import Thread
+from threading import Thread, Lock
+from time import time
+
+# Anything not needed by every command (simplejson, numpy, PIL, genmapping and the SDK tools it
+# imports, multiprocessing, archives, xml, http) is imported where it is used to keep startup fast.
+
+def json_load(f, **kwargs):
+    from simplejson import load
+    return load(f, **kwargs)
+
+def json_loads(s, **kwargs):
+    from simplejson import loads
+    return loads(s, **kwargs)
+
+def json_dump(obj, f, **kwargs):
+    from simplejson import dump
+    return dump(obj, f, **kwargs)
 
-from simplejson import dump as json_dump
+def json_dumps(obj, **kwargs):
+    from simplejson import dumps
+    return dumps(obj, **kwargs)
 
-from genmapping import gen_mapping
+# Set by load_numpy() and load_pil()
+numpy = None
+Image = None
+
+def load_numpy():
+    """Import numpy on first use. Returns False when it is not installed."""
+    global numpy
+    if numpy is None:
+        try:
+            import numpy
+        except ImportError:
+            return False
+    return True
+
+def load_pil():
+    """Import PIL on first use. Returns False when it is not installed."""
+    global Image
+    if Image is None:
+        try:
+            from PIL import Image
+        except ImportError:
+            return False
+    return True
+
+def parse_version(version):
+    """Numeric components of a dotted version string, e.g. (0, 20, 2), ordered like StrictVersion."""
+    return tuple(int(v) for v in version.split('.'))
 
 BUILDVERSION = '0.9.1'
 
@@ -34,6 +109,12 @@ except KeyError:
     pass
 #USER_ENV_PATH = USER_SDK_PATH + "\env"
 USER_APP_JSLIB_PATH = path_join('scripts', 'turbulenz')
+# Directories under assets/textures whose .png files are packed into atlases
+#USER_ATLAS_DIRS = ['ui']
+# Code outputs built for each template (default: all), e.g. ['canvas.release.html']
+#USER_CODE_VARIANTS = ['canvas.release.html']
+# Significant digits kept for floats in canonicalised JSON outputs, by source extension
+#USER_JSON_PRECISION = {'.dae': 6, '.obj': 6}
 
 # Clone of sh function from utils.turbulenz
 
@@ -80,6 +161,14 @@ def exec_command(command, cwd=None, env=None, verbose=False, console=False, igno
         else:
             Popen(command, stdout=PIPE, stderr=STDOUT, cwd=cwd, shell=shell)
 
+def import_sdk_tool(name):
+    for package in ['turbulenz_tools.tools', 'turbulenz.tools']:
+        try:
+            return __import__('%s.%s' % (package, name), fromlist=[name])
+        except ImportError:
+            pass
+    return None
+
 ############################################################
 
 def rm(path):
@@ -97,6 +186,22 @@ def mkdir(path):
         debug('mkdir: %s' % path)
         os.makedirs(path)
 
+def load_cache(env, name):
+    try:
+        with open(path_join(env['APP_BUILD_CACHE'], name + '.json'), 'r') as f:
+            return json_load(f)
+    except (IOError, ValueError):
+        return { }
+
+def save_cache(env, name, cache):
+    mkdir(env['APP_BUILD_CACHE'])
+    with open(path_join(env['APP_BUILD_CACHE'], name + '.json'), 'w') as f:
+        json_dump(cache, f, separators=(',', ':'))
+
+def file_stamp(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime]
+
 ############################################################
 
 def check_path_py_tools(env):
@@ -172,6 +277,7 @@ class Tool(object):
     app = None
     default_arg = None
     ext = None
+    exts = None
     configure = None
 
     tool = None
@@ -183,9 +289,9 @@ class Tool(object):
     def _required(self, sdk_version):
         if self.required:
             if self.before:
-                return sdk_version < self.before
+                return sdk_version < parse_version(self.before)
             elif self.after:
-                return sdk_version >= self.after
+                return sdk_version >= parse_version(self.after)
             else:
                 return True
         else:
@@ -241,6 +347,26 @@ class OBJ2JSON(Tool):
     default_arg = '--version'
     ext = '.obj'
 
+class NATIVEOBJ2JSON(Tool):
+    name = 'NATIVEOBJ2JSON'
+    ext = '.obj'
+
+    def configure(self, env, options):
+        if not load_numpy():
+            error("The native obj converter requires numpy")
+            return None
+        return 'obj2json (native)'
+
+    def build(self, env, options, input, output):
+        try:
+            obj2json(input, output)
+        except Exception as e:
+            # Any numpy failure (ValueError, IndexError, MemoryError...) falls back to the SDK tool
+            if 'OBJ2JSON' not in env:
+                raise CalledProcessError(1, 'obj2json (native): %s' % e)
+            info('Native obj converter cannot handle %s (%s), using: %s' % (input, e, env['OBJ2JSON'].tool))
+            env['OBJ2JSON'].build(env, options, input, output)
+
 class BMFONT2JSON(Tool):
     name = 'BMFONT2JSON'
     app = 'bmfont2json'
@@ -260,20 +386,20 @@ class JS2TZJS(Tool):
     name = 'JS2TZJS'
     app = 'js2tzjs'
     required = True
-    before = StrictVersion('0.19.0')
+    before = '0.19.0'
 
 class HTML2TZHTML(Tool):
     name = 'HTML2TZHTML'
     app = 'html2tzhtml'
     required = True
-    before = StrictVersion('0.19.0')
+    before = '0.19.0'
 
 class MAKETZJS(Tool):
     name = 'MAKETZJS'
     app = 'maketzjs'
     default_arg = '--version'
     required = True
-    after = StrictVersion('0.19.0')
+    after = '0.19.0'
 
     def build(self, env, options, input=None, mode=None, MF=None, output=None, templates=None, closure=None, yui=None):
         templates = templates or [ ]
@@ -294,14 +420,19 @@ class MAKETZJS(Tool):
             args.append(input)
         exec_command(args, console=True)
 
+# The SDK's makehtml script is 'from <module> import main'
+MAKEHTML_SCRIPT_IMPORT = re.compile(r'^from\s+([\w.]+)\s+import\s+main\s*$', re.M)
+# makehtml functions used to render variants in-process
+MAKEHTML_MODULE_API = ['_parser', 'env_create', 'check_input', 'html_generate', 'DEFAULT_HTML_TEMPLATE']
+
 class MAKEHTML(Tool):
     name = 'MAKEHTML'
     app = 'makehtml'
     default_arg = '--version'
     required = True
-    after = StrictVersion('0.19.0')
+    after = '0.19.0'
 
-    def build(self, env, options, input=None, mode=None, output=None, templates=None, code=None, template=None):
+    def _args(self, input=None, mode=None, output=None, templates=None, code=None, template=None):
         templates = templates or [ ]
         args = [self.tool]
         if mode:
@@ -324,8 +455,83 @@ class MAKEHTML(Tool):
             args.append(input)
         if template:
             args.append(template)
+        return args
+
+    def build(self, env, options, input=None, mode=None, output=None, templates=None, code=None, template=None):
+        args = self._args(input=input, mode=mode, output=output, templates=templates, code=code, template=template)
         exec_command(args, console=True, shell=True)
 
+    def _sdk_module(self):
+        """The SDK makehtml module the configured tool runs, if it can render in this process.
+
+        SDK environments install makehtml as a script that imports main() from the module, so the
+        module is found through that import. Returns None for any other makehtml.
+        """
+        tool = self.tool
+        if not path_exists(tool):
+            for path in os.environ.get('PATH', '').split(os.pathsep):
+                if os.path.isfile(path_join(path, tool)):
+                    tool = path_join(path, tool)
+                    break
+            else:
+                return None
+
+        module = None
+        if tool.endswith('.py'):
+            module = import_sdk_tool('makehtml')
+            if module is not None and \
+               os.path.realpath(path_splitext(module.__file__)[0] + '.py') != os.path.realpath(tool):
+                module = None
+        else:
+            try:
+                with open(tool, 'r') as f:
+                    match = MAKEHTML_SCRIPT_IMPORT.search(f.read(4096))
+                if match:
+                    module = __import__(match.group(1), fromlist=['main'])
+            except (IOError, ImportError):
+                module = None
+
+        if module is None or not all(hasattr(module, attr) for attr in MAKEHTML_MODULE_API):
+            return None
+        return module
+
+    def _render_batch(self, makehtml, input, variants, templates):
+        """Render the variants with one jinja environment, so the HTML template and the JS it
+        embeds are loaded and compiled once rather than once per variant."""
+        jinja_env = None
+        failed = [ ]
+        for (output, mode, code, template) in variants:
+            print '%s -> %s' % (input, output)
+            args = self._args(input=input, mode=mode, output=output, templates=templates, code=code, template=template)
+            (tool_options, tool_args) = makehtml._parser().parse_args(args[1:])
+            if jinja_env is None:
+                jinja_env = makehtml.env_create(tool_options, makehtml.DEFAULT_HTML_TEMPLATE)
+            try:
+                (input_js, input_html) = makehtml.check_input(tool_args)
+                makehtml.html_generate(jinja_env, tool_options, input_js, input_html)
+            except (SystemExit, Exception) as e:
+                error('makehtml failed for %s: %s' % (output, e))
+                failed.append(output)
+        if failed:
+            raise CalledProcessError(1, 'makehtml (%s)' % ', '.join(failed))
+
+    def build_batch(self, env, options, input, variants, templates=None):
+        """Build several (output, mode, code, template) variants of one input.
+
+        When the configured tool is the SDK makehtml all the variants are rendered in this process
+        from templates loaded once; otherwise makehtml is run once per variant.
+        """
+        makehtml = self._sdk_module()
+        if makehtml is not None:
+            info('Rendering HTML in-process with %s' % makehtml.__file__)
+            self._render_batch(makehtml, input, variants, templates)
+            return
+
+        for (output, mode, code, template) in variants:
+            print '%s -> %s' % (input, output)
+            exec_command(self._args(input=input, mode=mode, output=output, templates=templates,
+                                    code=code, template=template), console=True, shell=True)
+
 class JSON2JSON(Tool):
     name = 'JSON2JSON'
     app = 'json2json'
@@ -355,10 +561,155 @@ class CGFX2JSON(Tool):
         else:
             return tool
 
+def _nearest_pow2(n):
+    p = 1
+    while p * 2 <= n:
+        p *= 2
+    return p * 2 if n - p > p * 2 - n else p
+
+def generate_texture_mips(task):
+    """Write the power-of-two resized mip chain of an image; runs in a worker process.
+
+    Returns the level file names, largest first.
+    """
+    (src, out_dir, name, ext, texture_filter) = task
+    load_numpy()
+    load_pil()
+    image = Image.open(src)
+    image = image.convert('RGBA' if 'A' in image.getbands() or 'transparency' in image.info else 'RGB')
+    (width, height) = image.size
+    size = (_nearest_pow2(width), _nearest_pow2(height))
+    if size != image.size:
+        image = image.resize(size, Image.LANCZOS)
+
+    save_args = { 'quality': 95 } if ext in ('.jpg', '.jpeg') else { }
+    levels = [ ]
+    pixels = numpy.asarray(image, dtype=numpy.float32)
+    while True:
+        level = '%s.%i%s' % (name, len(levels), ext)
+        Image.fromarray(numpy.rint(pixels).astype(numpy.uint8), image.mode).save(path_join(out_dir, level), **save_args)
+        levels.append(level)
+
+        (height, width) = pixels.shape[:2]
+        if width == 1 and height == 1:
+            break
+        if texture_filter == 'lanczos':
+            resized = Image.fromarray(numpy.rint(pixels).astype(numpy.uint8), image.mode)
+            resized = resized.resize((max(1, width / 2), max(1, height / 2)), Image.LANCZOS)
+            pixels = numpy.asarray(resized, dtype=numpy.float32)
+        else:
+            if height > 1:
+                pixels = (pixels[0::2] + pixels[1::2]) * 0.5
+            if width > 1:
+                pixels = (pixels[:, 0::2] + pixels[:, 1::2]) * 0.5
+    return levels
+
+class TEXTUREMIPS(Tool):
+    """Resizes textures to power-of-two and generates their mip chains, cached by content hash."""
+    name = 'TEXTUREMIPS'
+    ext = '.png'
+    exts = ['.png', '.jpg', '.jpeg', '.tga']
+
+    def configure(self, env, options):
+        if not (load_numpy() and load_pil()):
+            error("Texture mips require numpy and PIL")
+            return None
+        self.staticmax = env['APP_STATICMAX']
+        self.cache = load_cache(env, 'textures')
+        self.pool = None
+        return 'texture mips (%s)' % options.texture_filter
+
+    def levels(self, options, src):
+        """The mip level file names of a source, largest first, generating them if needed."""
+        stamp = file_stamp(src)
+        cached = self.cache.get(src)
+        if cached and cached[0] == stamp:
+            content_hash = cached[1]
+        else:
+            with open(src, 'rb') as f:
+                content_hash = urlsafe_b64encode(md5(f.read() + options.texture_filter).digest()).strip('=')
+
+        if cached and cached[1] == content_hash and \
+           all(path_exists(path_join(self.staticmax, level)) for level in cached[2]):
+            self.cache[src] = [stamp, content_hash, cached[2]]
+            return cached[2]
+
+        levels = self.pool.apply(generate_texture_mips, [(src, self.staticmax, content_hash,
+                                                          path_splitext(src)[1].lower(), options.texture_filter)])
+        self.cache[src] = [stamp, content_hash, levels]
+        return levels
+
+    def build(self, env, options, input, output):
+        try:
+            levels = self.levels(options, input)
+        except (IOError, ValueError) as e:
+            raise CalledProcessError(1, 'texture mips: %s' % e)
+        copyfile(path_join(self.staticmax, levels[0]), output)
+
+    def start(self, options):
+        """Create the worker pool; call before any builder threads start, as it forks."""
+        from multiprocessing import Pool
+        self.pool = Pool(int(options.threads))
+
+    def finish(self, env):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        save_cache(env, 'textures', self.cache)
+
 ############################################################
 
-def configure(env, options):
+ASSET_TOOLS = [DAE2JSON, MATERIAL2JSON, EFFECT2JSON, LIGHT2JSON, XML2JSON, OBJ2JSON, BMFONT2JSON, MC2JSON,
+               JSON2JSON, CGFX2JSON]
+CODE_TOOLS = [JS2TZJS, HTML2TZHTML, MAKETZJS, MAKEHTML]
+
+def configure_paths(env, options):
+    """Configure the app paths and project settings, without looking for the SDK or its tools."""
     app_root = os.getcwd()
+    env['APP_ROOT'] = app_root
+
+    env['MAPPING_TABLE'] = 'mapping_table.json'
+    env['APP_MAPPING_TABLE'] = path_join(app_root, env['MAPPING_TABLE'])
+    env['APP_STATICMAX'] = path_join(app_root, 'staticmax')
+    env['APP_BUILD_CACHE'] = path_join(app_root, '.buildcache')
+    env['APP_TRASH'] = path_join(app_root, '.buildtrash')
+    env['APP_TEMPLATES'] = path_join(app_root, 'templates')
+    env['APP_SHADERS'] = path_join(app_root, 'assets', 'shaders')
+    env['APP_MATERIALS'] = path_join(app_root, 'assets', 'materials')
+    env['APP_MODELS'] = path_join(app_root, 'assets', 'models')
+    env['APP_TEXTURES'] = path_join(app_root, 'assets', 'textures')
+    env['APP_SOUNDS'] = path_join(app_root, 'assets', 'sounds')
+    env['APP_FONTS'] = path_join(app_root, 'assets', 'fonts')
+    env['APP_SCRIPTS'] = path_join(app_root, 'scripts')
+
+    atlas_dirs = list(options.atlas)
+    if 'USER_ATLAS_DIRS' in globals():
+        atlas_dirs.extend(USER_ATLAS_DIRS)
+    env['ATLAS_DIRS'] = atlas_dirs
+
+    json_precision = { }
+    if 'USER_JSON_PRECISION' in globals():
+        json_precision.update(USER_JSON_PRECISION)
+    for precision in options.json_precision:
+        try:
+            (ext, digits) = precision.split('=')
+            json_precision[ext] = int(digits)
+        except ValueError:
+            error("JSON precision not recognised (expected .ext=digits): %s" % precision)
+            return False
+    env['JSON_PRECISION'] = json_precision
+
+    if 'USER_APP_JSLIB_PATH' in globals():
+        env['APP_JSLIB'] = path_join(app_root, USER_APP_JSLIB_PATH)
+    else:
+        env['APP_JSLIB'] = path_join(app_root)
+
+    return True
+
+def configure(env, options, tool_classes):
+    """Find the SDK and the given tools. Slow: each tool is run to check it works."""
+    app_root = env['APP_ROOT']
     exe = ''
     turbulenz_os = ''
 
@@ -383,8 +734,8 @@ def configure(env, options):
     env['EXE_EXT_OS'] = exe
 
     try:
-        engine_version_minor = StrictVersion('.'.join(ENGINEVERSION.split('.')[0:2]))
-        engine_version = StrictVersion(ENGINEVERSION)
+        engine_version_minor = parse_version('.'.join(ENGINEVERSION.split('.')[0:2]))
+        engine_version = parse_version(ENGINEVERSION)
         env['ENGINE_VERSION_STR'] = ENGINEVERSION
         env['ENGINE_VERSION'] = engine_version
     except ValueError:
@@ -392,8 +743,8 @@ def configure(env, options):
         return False
 
     try:
-        sdk_version_minor = StrictVersion('.'.join(SDKVERSION.split('.')[0:2]))
-        sdk_version = StrictVersion(SDKVERSION)
+        sdk_version_minor = parse_version('.'.join(SDKVERSION.split('.')[0:2]))
+        sdk_version = parse_version(SDKVERSION)
         env['SDK_VERSION_STR'] = SDKVERSION
         env['SDK_VERSION'] = sdk_version
     except ValueError:
@@ -401,10 +752,10 @@ def configure(env, options):
         return False
 
     if engine_version != sdk_version:
-        warning("Target engine and SDK version don't match. Engine: %s, SDK: %s" % (engine_version, sdk_version))
+        warning("Target engine and SDK version don't match. Engine: %s, SDK: %s" % (ENGINEVERSION, SDKVERSION))
 
     if engine_version_minor != sdk_version_minor:
-        error("Target engine and SDK minor versions are not compatible. Engine: %s, SDK: %s" % (engine_version_minor, sdk_version_minor))
+        error("Target engine and SDK minor versions are not compatible. Engine: %s, SDK: %s" % (ENGINEVERSION, SDKVERSION))
         return False
 
     if 'USER_SDK_PATH' in globals():
@@ -441,7 +792,6 @@ def configure(env, options):
         return False
 
     env['ENV_PATH'] = env_path
-    env['APP_ROOT'] = app_root
     env['SDK_ROOT'] = sdk_root
     env['TOOLS_ROOT'] = path_join(sdk_root, 'tools')
     env['PYTOOLS_ROOT'] = path_join(app_root, 'tools')
@@ -451,9 +801,7 @@ def configure(env, options):
         warning("Path pytools_root has not been set (optional)")
 
     tools = { }
-    for tool in [DAE2JSON, MATERIAL2JSON, EFFECT2JSON, LIGHT2JSON, XML2JSON, OBJ2JSON, BMFONT2JSON, MC2JSON,
-                 JS2TZJS, HTML2TZHTML, MAKETZJS, MAKEHTML,
-                 JSON2JSON, CGFX2JSON]:
+    for tool in tool_classes:
         try:
             t = tool(env, options, sdk_version)
         except Tool.ConfigurationException as e:
@@ -464,27 +812,13 @@ def configure(env, options):
                 warning("Couldn't find tool: %s (optional)" % e.name)
         else:
             env[t.name] = t
-            tools[t.ext] = t
+            for ext in t.exts or [t.ext]:
+                tools[ext] = t
+    if 'OBJ2JSON' in env and options.obj_converter == 'sdk':
+        tools['.obj'] = env['OBJ2JSON']
     env['TOOLS'] = tools
     env['COPY_EXTENSIONS'] = set(['.ogg', '.png', '.jpeg', '.jpg', '.tga', '.dds'])
 
-    env['MAPPING_TABLE'] = 'mapping_table.json'
-    env['APP_MAPPING_TABLE'] = path_join(app_root, env['MAPPING_TABLE'])
-    env['APP_STATICMAX'] = path_join(app_root, 'staticmax')
-    env['APP_TEMPLATES'] = path_join(app_root, 'templates')
-    env['APP_SHADERS'] = path_join(app_root, 'assets', 'shaders')
-    env['APP_MATERIALS'] = path_join(app_root, 'assets', 'materials')
-    env['APP_MODELS'] = path_join(app_root, 'assets', 'models')
-    env['APP_TEXTURES'] = path_join(app_root, 'assets', 'textures')
-    env['APP_SOUNDS'] = path_join(app_root, 'assets', 'sounds')
-    env['APP_FONTS'] = path_join(app_root, 'assets', 'fonts')
-    env['APP_SCRIPTS'] = path_join(app_root, 'scripts')
-
-    if 'USER_APP_JSLIB_PATH' in globals():
-        env['APP_JSLIB'] = path_join(app_root, USER_APP_JSLIB_PATH)
-    else:
-        env['APP_JSLIB'] = path_join(app_root)
-
     return True
 
 ############################################################
@@ -525,44 +859,85 @@ def run_js2tzjs_jsinc(task):
 def _log_stage(stage):
     print '\n{0}\n{1: ^58}\n{0}\n'.format('-' * 58, stage)
 
+# HTML output suffix -> (makehtml mode, code suffix, uses the custom template)
+HTML_VARIANTS = {
+    '.canvas.debug.html': ('canvas-debug', None, True),
+    '.canvas.release.html': ('canvas', '.canvas.js', True),
+    '.canvas.default.debug.html': ('canvas-debug', None, False),
+    '.canvas.default.release.html': ('canvas', '.canvas.js', False),
+    '.debug.html': ('plugin-debug', None, True),
+    '.release.html': ('plugin', '.tzjs', True),
+    '.default.debug.html': ('plugin-debug', None, False),
+    '.default.release.html': ('plugin', '.tzjs', False)
+}
+
+# Code output suffixes in build order
+CODE_VARIANTS = ['.canvas.debug.html',
+                 '.canvas.release.html',
+                 '.canvas.default.debug.html',
+                 '.canvas.default.release.html',
+                 '.canvas.js',
+                 '.debug.html',
+                 '.release.html',
+                 '.default.debug.html',
+                 '.default.release.html',
+                 '.tzjs']
+
+# Code outputs only built when asked for, by --preload-manifest or --variants
+OPTIONAL_CODE_VARIANTS = ['.preload.json']
+
+def select_code_variants(names):
+    """Code output suffixes for the named variants, including the code the HTML variants load."""
+    selected = set()
+    for name in names:
+        suffix = '.' + name.strip().lstrip('.')
+        if suffix not in CODE_VARIANTS + OPTIONAL_CODE_VARIANTS:
+            raise ValueError('Unknown code variant: %s (expected one of %s)' %
+                             (name, ', '.join(v[1:] for v in CODE_VARIANTS + OPTIONAL_CODE_VARIANTS)))
+        selected.add(suffix)
+        if suffix in HTML_VARIANTS and HTML_VARIANTS[suffix][1]:
+            selected.add(HTML_VARIANTS[suffix][1])
+    return [v for v in CODE_VARIANTS + OPTIONAL_CODE_VARIANTS if v in selected]
+
+def html_templates_dirs(env):
+    return [env['APP_ROOT'], env['APP_TEMPLATES'], env['APP_JSLIB']]
+
+def find_html_template(appname, templates_dirs):
+    for t in templates_dirs:
+        template = path_join(t, '%s.html' % appname)
+        if path_exists(template):
+            return path_basename(template)
+    return None
+
+def build_html(src, dsts, env, options):
+    """Build all the HTML variants of a template in one batch, searching for its template once."""
+    input = path_basename(src)
+    appname, _ = path_splitext(input)
+    templates_dirs = html_templates_dirs(env)
+    template = find_html_template(appname, templates_dirs)
+
+    variants = [ ]
+    for dst in dsts:
+        (mode, code_ext, custom) = HTML_VARIANTS[dst[len(appname):]]
+        variants.append((dst, mode, appname + code_ext if code_ext else None, template if custom else None))
+
+    try:
+        env['MAKEHTML'].build_batch(env, options, input, variants, templates=templates_dirs)
+    except CalledProcessError as e:
+        error('Command failed: %s' % e)
+        return False
+    return True
+
 def build_code(src, dst, env, options):
     input = path_basename(src)
     appname, _ = path_splitext(input)
-    code = '%s.canvas.js' % appname
-    tzjs = '%s.tzjs' % appname
 
     dependency_file = '%s.deps' % src
 
-    templates_dirs = [env['APP_ROOT'], env['APP_TEMPLATES'], env['APP_JSLIB']]
-    for t in templates_dirs:
-        template = path_join(t, '%s.html' % appname)
-        if path_exists(template):
-            template = path_basename(template)
-            break
-    else:
-        template = None
-
-    if dst.endswith('.canvas.debug.html'):
-        env['MAKEHTML'].build(env, options, input=input, output=dst,
-                              mode='canvas-debug',
-                              templates=templates_dirs,
-                              template=template)
-    elif dst.endswith('.canvas.release.html'):
-        env['MAKEHTML'].build(env, options, input=input, output=dst,
-                              mode='canvas',
-                              code=code,
-                              templates=templates_dirs,
-                              template=template)
-    elif dst.endswith('.canvas.default.debug.html'):
-        env['MAKEHTML'].build(env, options, input=input, output=dst,
-                              mode='canvas-debug',
-                              templates=templates_dirs)
-    elif dst.endswith('.canvas.default.release.html'):
-        env['MAKEHTML'].build(env, options, input=input, output=dst,
-                              mode='canvas',
-                              code=code,
-                              templates=templates_dirs)
-    elif dst.endswith('.canvas.js'):
+    templates_dirs = html_templates_dirs(env)
+
+    # HTML variants are built together by build_html
+    if dst.endswith('.canvas.js'):
         if options.closure:
             env['MAKETZJS'].build(env, options, input=input, output=dst,
                                   mode='canvas',
@@ -573,28 +948,8 @@ def build_code(src, dst, env, options):
             env['MAKETZJS'].build(env, options, input=input, output=dst,
                                   mode='canvas',
                                   templates=templates_dirs)
-    elif dst.endswith('.debug.html'):
-        env['MAKEHTML'].build(env, options, input=input, output=dst,
-                              mode='plugin-debug',
-                              templates=templates_dirs,
-                              template=template)
-    elif dst.endswith('.release.html'):
-        env['MAKEHTML'].build(env, options, input=input, output=dst,
-                              mode='plugin',
-                              code=tzjs,
-                              templates=templates_dirs,
-                              template=template)
-    elif dst.endswith('.default.debug.html'):
-        env['MAKEHTML'].build(env, options, input=input, output=dst,
-                              mode='plugin-debug',
-                              templates=templates_dirs)
-    elif dst.endswith('.default.release.html'):
-        env['MAKEHTML'].build(env, options, input=input, output=dst,
-                              mode='plugin',
-                              code=tzjs,
-                              templates=templates_dirs)
     elif dst.endswith('.tzjs'):
-        if env['SDK_VERSION'] < StrictVersion('0.19.0'):
+        if env['SDK_VERSION'] < parse_version('0.19.0'):
             run_js2tzjs({
                 'inputs': [src],
                 'outputs': [dst],
@@ -606,6 +961,8 @@ def build_code(src, dst, env, options):
                                   mode='plugin',
                                   yui=options.yui,
                                   templates=templates_dirs)
+    elif dst.endswith('.preload.json'):
+        return build_preload_manifest(src, dst, env, options)
     elif dst.endswith('.jsinc'):
         run_js2tzjs_jsinc({
             'inputs': [src],
@@ -618,7 +975,7 @@ def build_code(src, dst, env, options):
 
     return True
 
-def google_compile(dependency_file, output_file, path_to_closure):
+def parse_dependency_file(dependency_file):
     with open(dependency_file, 'r') as f:
         file_contents = f.read()
 
@@ -637,6 +994,11 @@ def google_compile(dependency_file, output_file, path_to_closure):
                     f = path_abspath(f)
                     dependencies.add(f)
 
+    return dependencies
+
+def google_compile(dependency_file, output_file, path_to_closure):
+    dependencies = parse_dependency_file(dependency_file)
+
     # Create flag file
     flag_file_path = 'flagfile.txt'
     with open(flag_file_path, 'w') as flag_file:
@@ -662,6 +1024,128 @@ def google_compile(dependency_file, output_file, path_to_closure):
     _log_stage('RUNNING CLOSURE COMPILER')
     exec_command(args, console=True, shell=True)
 
+_JS_STRING = re.compile(r'"((?:[^"\\\n]|\\.)+)"|\'((?:[^\'\\\n]|\\.)+)\'')
+
+def _cached_js_strings(path, cache):
+    stamp = file_stamp(path)
+    cached = cache.get(path)
+    if cached and cached[0] == stamp:
+        return cached[1]
+    with open(path, 'rb') as f:
+        strings = sorted(set(a or b for (a, b) in _JS_STRING.findall(f.read())
+                             if '.' in (a or b)))
+    cache[path] = [stamp, strings]
+    return strings
+
+def _code_dependencies(src, env, options, cache):
+    """The JS files a template's code is built from, cached by the stamps of those files.
+
+    Reuses the .deps file of a --closure .canvas.js build when it is newer than everything it
+    lists, and otherwise runs maketzjs -M.
+    """
+    cached = cache.get(src)
+    if cached and all(path_exists(path) and file_stamp(path) == stamp for path, stamp in cached.iteritems()):
+        return set(cached)
+
+    dependency_file = '%s.deps' % src
+    js_files = None
+    if path_exists(dependency_file):
+        js_files = parse_dependency_file(dependency_file)
+        newest = max([os.path.getmtime(path) for path in js_files if path_exists(path)] + [os.path.getmtime(src)])
+        if os.path.getmtime(dependency_file) < newest:
+            js_files = None
+
+    if js_files is None:
+        dependency_file = '%s.preload.deps' % src
+        scratch = '%s.preload.js' % src
+        try:
+            env['MAKETZJS'].build(env, options, input=path_basename(src), output=scratch,
+                                  mode='canvas',
+                                  MF=dependency_file,
+                                  templates=html_templates_dirs(env))
+            js_files = parse_dependency_file(dependency_file)
+        finally:
+            rm(dependency_file)
+            rm(scratch)
+
+    js_files.add(path_abspath(src))
+    cache[src] = dict((path, file_stamp(path)) for path in js_files if path_exists(path))
+    return js_files
+
+def build_preload_manifest(src, dst, env, options):
+    """Write the staticmax files a template references, found statically in its code and assets.
+
+    String literals in the template's JS dependencies (from maketzjs -M) that name assets in the
+    mapping table are followed through the references of .dae, .material, .effect and .json assets.
+    """
+    if not path_exists(env['APP_MAPPING_TABLE']):
+        warning('No mapping table, build assets before the preload manifest: %s' % dst)
+        return False
+    with open(env['APP_MAPPING_TABLE'], 'r') as f:
+        mapping_table_obj = json_load(f)
+    urn_mapping = mapping_table_obj['urnmapping']
+    atlas_mapping = mapping_table_obj.get('atlasmapping', { })
+    mip_mapping = mapping_table_obj.get('mipmapping', { })
+
+    dependencies_cache = load_cache(env, 'preload_deps')
+    try:
+        js_files = _code_dependencies(src, env, options, dependencies_cache)
+    except (CalledProcessError, IOError, OSError) as e:
+        error('Failed to find the code dependencies of %s: %s' % (src, e))
+        return False
+    save_cache(env, 'preload_deps', dependencies_cache)
+
+    lookup = _reference_lookup(urn_mapping)
+    strings_cache = load_cache(env, 'preload')
+    references_cache = load_cache(env, 'references')
+
+    urns = set()
+    for js_file in sorted(js_files):
+        if not path_exists(js_file):
+            continue
+        for string in _cached_js_strings(js_file, strings_cache):
+            urn = lookup.get(os.path.normpath(string).replace('\\', '/'))
+            if urn:
+                urns.add(urn)
+
+    queue = list(urns)
+    while queue:
+        urn = queue.pop()
+        asset_src = path_join('assets', os.path.normpath(urn)).replace('\\', '/')
+        if path_splitext(asset_src)[1] not in REFERENCE_EXTENSIONS or not path_exists(asset_src):
+            continue
+        for reference in _cached_references(asset_src, references_cache):
+            dep = resolve_asset_reference(urn, reference, lookup)
+            if dep and dep not in urns:
+                urns.add(dep)
+                queue.append(dep)
+
+    save_cache(env, 'preload', strings_cache)
+    save_cache(env, 'references', references_cache)
+
+    files = [ ]
+    seen = set()
+    for urn in sorted(urns):
+        names = [urn_mapping[urn]]
+        if urn + '.bin' in urn_mapping:
+            names.append(urn_mapping[urn + '.bin'])
+        if urn in atlas_mapping:
+            names.append(atlas_mapping[urn]['atlas'])
+        names.extend(mip_mapping.get(urn, [ ]))
+        for name in names:
+            path = path_join(env['APP_STATICMAX'], name)
+            if name in seen or not path_exists(path):
+                continue
+            seen.add(name)
+            files.append({ 'urn': urn, 'file': name, 'size': os.path.getsize(path) })
+
+    with open(dst, 'w') as f:
+        json_dump({ 'version': 1,
+                    'files': files,
+                    'totalSize': sum(entry['size'] for entry in files) }, f, separators=(',', ':'))
+    print '%i files (%i bytes)' % (len(files), sum(entry['size'] for entry in files))
+    return True
+
 ############################################################
 
 def build_asset(src, dest, env, options):
@@ -681,31 +1165,1315 @@ def build_asset(src, dest, env, options):
     else:
         return True
 
-def clean(env):
+############################################################
+
+def _obj_lines(buf):
+    ends = numpy.flatnonzero(buf == ord('\n')) + 1
+    if len(ends) == 0 or ends[-1] != len(buf):
+        ends = numpy.append(ends, len(buf))
+    starts = numpy.concatenate(([0], ends[:-1]))
+    return (starts, ends - starts)
+
+def _obj_select(buf, starts, lengths, mask, prefix):
+    """Copy of the bytes of the selected lines with their keyword blanked out."""
+    selected = buf[numpy.repeat(mask, lengths)]
+    offsets = numpy.concatenate(([0], numpy.cumsum(lengths[mask])[:-1]))
+    for i in xrange(prefix):
+        selected[offsets + i] = ord(' ')
+    return selected
+
+def _obj_tokens(chars):
+    """Start of each line of the selected bytes and the number of tokens on it."""
+    whitespace = chars <= ord(' ')
+    token_starts = ~whitespace
+    token_starts[1:] &= whitespace[:-1]
+    line_starts = numpy.concatenate(([0], numpy.flatnonzero(chars == ord('\n')) + 1))
+    line_starts = line_starts[line_starts < len(chars)]
+    return (line_starts, numpy.add.reduceat(token_starts.astype(numpy.int64), line_starts))
+
+def _obj_floats(buf, starts, lengths, mask, prefix, width):
+    count = int(numpy.count_nonzero(mask))
+    if count == 0:
+        return numpy.zeros((0, width))
+    selected = _obj_select(buf, starts, lengths, mask, prefix)
+    (_, components) = _obj_tokens(selected)
+    if len(components) != count or numpy.any(components != components[0]):
+        raise ValueError('inconsistent number of components per vertex')
+    values = numpy.fromstring(selected.tostring(), sep=' ')
+    if values.size != count * components[0]:
+        raise ValueError('malformed vertex')
+    return values.reshape(count, -1)[:, :width]
+
+def _obj_faces(buf, starts, lengths, mask):
+    """Parse all face lines at once into (corners, vertices per face)."""
+    text = _obj_select(buf, starts, lengths, mask, 1).tostring().replace('//', '/0/')
+    chars = numpy.frombuffer(text, dtype=numpy.uint8)
+    (line_starts, counts) = _obj_tokens(chars)
+
+    # Every face must use the same v, v/vt or v/vt/vn format
+    num_corners = int(counts.sum())
+    slashes = numpy.add.reduceat((chars == ord('/')).astype(numpy.int64), line_starts)
+    if num_corners == 0 or slashes[0] % max(counts[0], 1):
+        raise ValueError('inconsistent face vertex formats')
+    num_components = int(slashes[0] / max(counts[0], 1)) + 1
+    if numpy.any(slashes != counts * (num_components - 1)):
+        raise ValueError('inconsistent face vertex formats')
+
+    corners = numpy.fromstring(text.replace('/', ' '), dtype=numpy.int64, sep=' ')
+    if corners.size != num_corners * num_components:
+        raise ValueError('malformed face')
+    return (corners.reshape(num_corners, num_components), counts)
+
+def obj2json(input, output):
+    """In-process replacement for the obj2json tool, vectorised over a memory-mapped file."""
+    buf = numpy.memmap(input, dtype=numpy.uint8, mode='c') if os.path.getsize(input) else numpy.zeros(0, numpy.uint8)
+    (starts, lengths) = _obj_lines(buf)
+    padded = numpy.append(buf, [ord('\n'), ord('\n')])
+    c0 = padded[starts]
+    c1 = padded[starts + 1]
+    spaced = (c1 == ord(' ')) | (c1 == ord('\t'))
+    is_v = (c0 == ord('v')) & spaced
+    is_vt = (c0 == ord('v')) & (c1 == ord('t'))
+    is_vn = (c0 == ord('v')) & (c1 == ord('n'))
+    is_f = (c0 == ord('f')) & spaced
+    is_usemtl = (c0 == ord('u'))
+
+    positions = _obj_floats(buf, starts, lengths, is_v, 1, 3)
+    uvs = _obj_floats(buf, starts, lengths, is_vt, 2, 2)
+    normals = _obj_floats(buf, starts, lengths, is_vn, 2, 3)
+    if not numpy.any(is_f):
+        raise ValueError('no faces')
+    (corners, counts) = _obj_faces(buf, starts, lengths, is_f)
+
+    # Resolve relative (negative) indices against the elements defined before each face
+    face_lines = numpy.flatnonzero(is_f)
+    for component, element_mask in enumerate([is_v, is_vt, is_vn][:corners.shape[1]]):
+        defined = numpy.repeat(numpy.searchsorted(numpy.flatnonzero(element_mask), face_lines), counts)
+        column = corners[:, component]
+        column[column < 0] += defined[column < 0] + 1
+    corners -= 1
+
+    # Materials become surfaces, one per material name however many usemtl blocks use it
+    materials = ['default']
+    block_material = [0]
+    usemtl_lines = numpy.flatnonzero(is_usemtl)
+    for line in usemtl_lines:
+        tokens = buf[starts[line]:starts[line] + lengths[line]].tostring().split()
+        name = tokens[1] if len(tokens) > 1 and tokens[0] == 'usemtl' else 'default'
+        if name not in materials:
+            materials.append(name)
+        block_material.append(materials.index(name))
+    face_material = numpy.array(block_material)[numpy.searchsorted(usemtl_lines, face_lines)]
+
+    # Fan triangulation of every polygon
+    num_triangles = numpy.maximum(counts - 2, 0)
+    face_start = numpy.concatenate(([0], numpy.cumsum(counts)[:-1]))
+    tri_face = numpy.repeat(numpy.arange(len(counts)), num_triangles)
+    fan = numpy.arange(len(tri_face)) - numpy.repeat(numpy.cumsum(num_triangles) - num_triangles, num_triangles) + 1
+    tri_base = face_start[tri_face]
+    triangles = numpy.column_stack((tri_base, tri_base + fan, tri_base + fan + 1))
+
+    # Unique position/uv/normal index tuples, numbered in order of first use
+    (keys, first, inverse) = numpy.unique(corners, axis=0, return_index=True, return_inverse=True)
+    order = numpy.argsort(first, kind='mergesort')
+    rank = numpy.empty_like(order)
+    rank[order] = numpy.arange(len(order))
+    keys = keys[order]
+    triangles = rank[inverse.ravel()][triangles]
+
+    shape = path_splitext(path_basename(input))[0]
+    sources = { }
+    inputs = { }
+
+    def _attach(semantic, name, data, indices):
+        if numpy.any(indices < 0) or numpy.any(indices >= len(data)):
+            return
+        values = data[indices]
+        sources[name] = {
+            'data': values.ravel().tolist(),
+            'max': values.max(axis=0).tolist(),
+            'min': values.min(axis=0).tolist(),
+            'stride': values.shape[1]
+        }
+        inputs[semantic] = { 'offset': 0, 'source': name }
+
+    _attach('POSITION', 'positions', positions, keys[:, 0])
+    if keys.shape[1] > 1:
+        _attach('TEXCOORD0', 'texcoords', uvs, keys[:, 1])
+    if keys.shape[1] > 2:
+        _attach('NORMAL', 'normals', normals, keys[:, 2])
+    if 'POSITION' not in inputs:
+        raise ValueError('face references an undefined vertex')
+
+    surfaces = { }
+    instances = { }
+    tri_material = face_material[tri_face]
+    for material in numpy.unique(tri_material):
+        surface_triangles = triangles[tri_material == material]
+        name = materials[material]
+        surfaces[name] = {
+            'numPrimitives': len(surface_triangles),
+            'triangles': surface_triangles.ravel().tolist()
+        }
+        instances['%s-%s' % (shape, name)] = { 'geometry': shape, 'material': name, 'surface': name }
+
+    asset = {
+        'version': 1,
+        'geometries': { shape: { 'inputs': inputs, 'sources': sources, 'surfaces': surfaces } },
+        'nodes': { shape: { 'geometryinstances': instances } }
+    }
+    with open(output, 'w') as f:
+        json_dump(asset, f, separators=(',', ':'), sort_keys=True)
+
+# Always compared by --compare-obj: a material used by two separate usemtl blocks
+OBJ_SAMPLE_REUSED_MATERIAL = '''v 0 0 0
+v 1 0 0
+v 1 1 0
+v 0 1 0
+v 2 0 0
+v 2 1 0
+usemtl red
+f 1 2 3
+usemtl blue
+f 2 5 6
+usemtl red
+f 1 3 4
+'''
+
+# Faces with different vertex formats, which the native converter leaves to obj2json
+OBJ_SAMPLE_MIXED_FACES = '''v 0 0 0
+v 1 0 0
+v 1 1 0
+v 0 1 0
+v 2 0 0
+v 2 1 0
+vt 0 0
+vt 1 0
+vt 1 1
+vn 0 0 1
+vn 0 0 1
+vn 0 0 1
+f 1/1/1 2/2/2 3/3/3
+f 4 5 6
+'''
+
+OBJ_SAMPLES = { 'reused_material.obj': OBJ_SAMPLE_REUSED_MATERIAL,
+                'mixed_faces.obj': OBJ_SAMPLE_MIXED_FACES }
+
+def compare_obj_converters(env, options):
+    if 'OBJ2JSON' not in env or 'NATIVEOBJ2JSON' not in env:
+        error('Comparing requires both the obj2json tool and the native converter')
+        return 1
+
+    sources = [path_join(root, f) for root, _, files in os.walk('assets') for f in files if f.endswith('.obj')]
+    mkdir(env['APP_BUILD_CACHE'])
+    samples = [ ]
+    for name, sample in sorted(OBJ_SAMPLES.iteritems()):
+        samples.append(path_join(env['APP_BUILD_CACHE'], name))
+        with open(samples[-1], 'w') as f:
+            f.write(sample)
+    sources.extend(samples)
+
+    mismatches = 0
+    for src in sorted(sources):
+        timings = { }
+        outputs = { }
+        converters = [('OBJ2JSON', lambda dest: env['OBJ2JSON'].build(env, options, src, dest)),
+                      ('NATIVEOBJ2JSON', lambda dest: env['NATIVEOBJ2JSON'].build(env, options, src, dest))]
+        try:
+            for name, convert in converters:
+                dest = '%s.%s.json' % (src, name.lower())
+                start = time()
+                try:
+                    convert(dest)
+                    timings[name] = time() - start
+                    with open(dest, 'rb') as f:
+                        outputs[name] = f.read()
+                finally:
+                    rm(dest)
+        except Exception as e:
+            print '%s: FAILED (%s)' % (src, e)
+            mismatches += 1
+            continue
+
+        if outputs['OBJ2JSON'] == outputs['NATIVEOBJ2JSON']:
+            result = 'identical'
+        else:
+            result = 'DIFFERENT'
+            mismatches += 1
+        print '%s: %s (sdk: %.3fs, native: %.3fs, %.1fx)' % (src, result,
+                                                          timings['OBJ2JSON'], timings['NATIVEOBJ2JSON'],
+                                                          timings['OBJ2JSON'] / max(timings['NATIVEOBJ2JSON'], 1e-6))
+
+    for sample in samples:
+        rm(sample)
+    return mismatches
+
+############################################################
+
+GEOMETRY_EXTENSIONS = ['.dae', '.obj']
+GEOMETRY_ALIGNMENT = 4
+
+def _geometry_quantisation(semantic, options):
+    """Bits and whether the values are signed normalised for a geometry input semantic."""
+    if semantic == 'POSITION':
+        return (int(options.quantise_positions), False)
+    elif semantic in ('NORMAL', 'TANGENT', 'BINORMAL'):
+        return (int(options.quantise_normals), True)
+    elif semantic.startswith('TEXCOORD'):
+        return (int(options.quantise_uvs), False)
+    return (0, False)
+
+def _quantise(values, bits, signed_normalised):
+    """Returns (quantised, scale, offset) where values ~= quantised * scale + offset."""
+    components = values.shape[1]
+    if signed_normalised:
+        limit = (1 << (bits - 1)) - 1
+        dtype = numpy.int8 if bits == 8 else numpy.int16
+        quantised = numpy.clip(numpy.rint(values * limit), -limit, limit).astype(dtype)
+        return (quantised, [1.0 / limit] * components, [0.0] * components)
+
+    dtype = numpy.uint8 if bits == 8 else numpy.uint16
+    low = values.min(axis=0)
+    scale = (values.max(axis=0) - low) / ((1 << bits) - 1)
+    scale[scale == 0] = 1.0
+    quantised = numpy.rint((values - low) / scale).astype(dtype)
+    return (quantised, scale.tolist(), low.tolist())
+
+def pack_geometry_buffers(urn, dest, options):
+    """Move the large numeric arrays of a mesh JSON output into a content-hashed binary buffer.
+
+    Returns the {urn: file} mapping table entries for the asset's buffers.
+    """
+    with open(dest, 'r') as f:
+        asset = json_load(f)
+
+    buffer_urn = '%s.bin' % urn
+    chunks = [ ]
+    size = [0]
+    threshold = int(options.binary_geometry_threshold)
+
+    def _view(array):
+        padding = -size[0] % GEOMETRY_ALIGNMENT
+        if padding:
+            chunks.append('\0' * padding)
+            size[0] += padding
+        view = {
+            'buffer': buffer_urn,
+            'byteOffset': size[0],
+            'count': array.size,
+            'type': array.dtype.name
+        }
+        data = array.astype(array.dtype.newbyteorder('<')).tostring()
+        chunks.append(data)
+        size[0] += len(data)
+        return view
+
+    for geometry in asset.get('geometries', { }).itervalues():
+        semantics = dict((i['source'], semantic) for semantic, i in geometry.get('inputs', { }).iteritems()
+                         if 'source' in i)
+        for name, source in geometry.get('sources', { }).iteritems():
+            data = source.get('data')
+            if not isinstance(data, list) or len(data) < threshold:
+                continue
+            values = numpy.array(data, dtype=numpy.float64).reshape(-1, source.get('stride', 1))
+            (bits, signed_normalised) = _geometry_quantisation(semantics.get(name, ''), options)
+            if bits:
+                (values, source['scale'], source['offset']) = _quantise(values, bits, signed_normalised)
+            else:
+                values = values.astype(numpy.float32)
+            del source['data']
+            source.update(_view(values))
+
+        for surface in geometry.get('surfaces', { }).itervalues():
+            for primitives in ('triangles', 'lines'):
+                indices = surface.get(primitives)
+                if not isinstance(indices, list) or len(indices) < threshold:
+                    continue
+                indices = numpy.array(indices, dtype=numpy.uint32)
+                if len(indices) and indices.max() < 0x10000:
+                    indices = indices.astype(numpy.uint16)
+                surface[primitives] = _view(indices)
+
+    buffers = asset.setdefault('buffers', { })
+    if chunks:
+        data = ''.join(chunks)
+        buffer_file = urlsafe_b64encode(md5(data).digest()).strip('=') + '.bin'
+        buffer_path = path_join(path_split(dest)[0], buffer_file)
+        if not path_exists(buffer_path):
+            with open(buffer_path, 'wb') as f:
+                f.write(data)
+        buffers[buffer_urn] = { 'file': buffer_file, 'byteLength': len(data) }
+
+        with open(dest, 'w') as f:
+            json_dump(asset, f, separators=(',', ':'))
+
+    return dict((buffer_urn, b['file']) for buffer_urn, b in buffers.iteritems())
+
+############################################################
+
+ATLAS_MAX_SIZE = 2048
+ATLAS_PADDING = 1
+ATLAS_VERSION = 1
+
+class MaxRectsPacker(object):
+    """MaxRects bin packer using the best short side fit heuristic."""
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.free = [(0, 0, width, height)]
+
+    def insert(self, width, height):
+        best = None
+        best_score = None
+        for (fx, fy, fw, fh) in self.free:
+            if width <= fw and height <= fh:
+                leftover_w = fw - width
+                leftover_h = fh - height
+                score = (min(leftover_w, leftover_h), max(leftover_w, leftover_h))
+                if best_score is None or score < best_score:
+                    best = (fx, fy)
+                    best_score = score
+        if best is None:
+            return None
+
+        self._place(best[0], best[1], width, height)
+        return best
+
+    def _place(self, x, y, width, height):
+        free = []
+        for rect in self.free:
+            (fx, fy, fw, fh) = rect
+            if x >= fx + fw or x + width <= fx or y >= fy + fh or y + height <= fy:
+                free.append(rect)
+                continue
+            if x > fx:
+                free.append((fx, fy, x - fx, fh))
+            if x + width < fx + fw:
+                free.append((x + width, fy, fx + fw - x - width, fh))
+            if y > fy:
+                free.append((fx, fy, fw, y - fy))
+            if y + height < fy + fh:
+                free.append((fx, y + height, fw, fy + fh - y - height))
+
+        # Prune free rectangles contained in another
+        self.free = [a for i, a in enumerate(free)
+                     if not any(i != j and
+                                a[0] >= b[0] and a[1] >= b[1] and
+                                a[0] + a[2] <= b[0] + b[2] and a[1] + a[3] <= b[1] + b[3] and
+                                (a != b or j < i)
+                                for j, b in enumerate(free))]
+
+def _next_pow2(n):
+    p = 1
+    while p < n:
+        p <<= 1
+    return p
+
+def pack_atlases(sizes, max_size=ATLAS_MAX_SIZE, padding=ATLAS_PADDING):
+    """Pack {key: (width, height)} into as few power-of-two pages as possible.
+
+    Returns a list of (width, height, {key: (x, y)}) pages.
+    """
+    remaining = sorted(sizes.iteritems(), key=lambda (k, (w, h)): (max(w, h), w * h, k), reverse=True)
+    pages = []
+    while remaining:
+        area = sum((w + padding) * (h + padding) for _, (w, h) in remaining)
+        width = height = min(_next_pow2(int(area ** 0.5)), max_size)
+        if width * height / 2 >= area:
+            height /= 2
+        while True:
+            packer = MaxRectsPacker(width, height)
+            placed = {}
+            unplaced = []
+            for key, (w, h) in remaining:
+                pos = packer.insert(w + padding, h + padding)
+                if pos is None:
+                    unplaced.append((key, (w, h)))
+                else:
+                    placed[key] = pos
+            if not unplaced or (width == max_size and height == max_size):
+                break
+            if width <= height:
+                width = min(width * 2, max_size)
+            else:
+                height = min(height * 2, max_size)
+        if not placed:
+            raise ValueError('Images too large for a %ix%i atlas: %s' % (max_size, max_size, [k for k, _ in unplaced]))
+        pages.append((width, height, placed))
+        remaining = unplaced
+    return pages
+
+def get_content_hash(filename):
+    with open(filename, 'rb') as f:
+        return md5(f.read()).hexdigest()
+
+def _atlas_name(members):
+    key = md5(str(ATLAS_VERSION))
+    for urn, content_hash in sorted(members.iteritems()):
+        key.update(urn)
+        key.update(content_hash)
+    return urlsafe_b64encode(key.digest()).strip('=')
+
+def _build_atlas(sources, name, env):
+    sizes = {}
+    for urn, src in sources.iteritems():
+        sizes[urn] = Image.open(src).size
+
+    atlas = {
+        'version': ATLAS_VERSION,
+        'pages': [ ],
+        'frames': { }
+    }
+    for index, (width, height, placed) in enumerate(pack_atlases(sizes)):
+        pixels = numpy.zeros((height, width, 4), dtype=numpy.uint8)
+        for urn, (x, y) in placed.iteritems():
+            image = numpy.asarray(Image.open(sources[urn]).convert('RGBA'))
+            (h, w) = image.shape[:2]
+            pixels[y:y + h, x:x + w] = image
+            atlas['frames'][urn] = {
+                'page': index,
+                'rect': [x, y, w, h],
+                'uv': [float(x) / width, float(y) / height, float(x + w) / width, float(y + h) / height]
+            }
+        page_name = '%s.%i.png' % (name, index)
+        Image.fromarray(pixels, 'RGBA').save(path_join(env['APP_STATICMAX'], page_name), optimize=True)
+        atlas['pages'].append({'image': page_name, 'width': width, 'height': height})
+    return atlas
+
+def build_atlases(env, options, mapping_table_obj, build_deps):
+    """Replace the configured .png textures with atlas pages, cached by the member content hashes."""
+    if not (load_numpy() and load_pil()):
+        error('Texture atlases require numpy and PIL (atlases not built)')
+        return False
+
+    urn_mapping = mapping_table_obj['urnmapping']
+    atlas_mapping = mapping_table_obj.setdefault('atlasmapping', { })
+    textures_root = path_join('assets', 'textures')
+
+    for atlas_dir in env['ATLAS_DIRS']:
+        prefix = path_join(textures_root, atlas_dir, '').replace('\\', '/')
+        sources = dict((src[len('assets/'):], src) for src in build_deps
+                       if src.startswith(prefix) and src.lower().endswith('.png'))
+        if not sources:
+            warning('No .png files to atlas in: %s' % prefix)
+            continue
+
+        members = dict((urn, get_content_hash(src)) for urn, src in sources.iteritems())
+        name = _atlas_name(members)
+        atlas_urn = 'textures/%s.atlas.json' % atlas_dir.strip('/')
+        atlas_file = '%s.atlas.json' % name
+        atlas_path = path_join(env['APP_STATICMAX'], atlas_file)
+
+        if path_exists(atlas_path):
+            print '%s (%i images) -> %s (cached)' % (prefix, len(sources), atlas_path)
+            with open(atlas_path, 'r') as f:
+                atlas = json_load(f)
+        else:
+            print '%s (%i images) -> %s' % (prefix, len(sources), atlas_path)
+            try:
+                atlas = _build_atlas(sources, name, env)
+            except (IOError, ValueError) as e:
+                error('Failed to build atlas %s: %s' % (atlas_dir, e))
+                continue
+            with open(atlas_path, 'w') as f:
+                json_dump(atlas, f, separators=(',', ':'))
+
+        urn_mapping[atlas_urn] = atlas_file
+        for urn, frame in atlas['frames'].iteritems():
+            page = atlas['pages'][frame['page']]
+            urn_mapping[urn] = page['image']
+            atlas_mapping[urn] = {
+                'atlas': atlas_file,
+                'image': page['image'],
+                'rect': frame['rect'],
+                'uv': frame['uv']
+            }
+            del build_deps[sources[urn]]
+
+    return True
+
+def _round_floats(obj, digits):
+    if isinstance(obj, float):
+        return float('%.*g' % (digits, obj))
+    elif isinstance(obj, dict):
+        return dict((k, _round_floats(v, digits)) for k, v in obj.iteritems())
+    elif isinstance(obj, list):
+        return [_round_floats(v, digits) for v in obj]
+    return obj
+
+def canonicalise_json(task):
+    """Rewrite a JSON output with minimal separators and optionally rounded floats and sorted keys.
+
+    Runs in a worker process; returns (path, bytes before, bytes after, error).
+    """
+    (path, digits, sort_keys) = task
     try:
-        rmdir(env['APP_STATICMAX'])
-        rm(env['APP_MAPPING_TABLE'])
-
-        # Aggressive root level cleaning
-        for f in os.listdir(env['APP_ROOT']):
-            (filename, ext) = path_splitext(f)
-
-            # Also cleans previous SDK content e.g. .jsinc
-            if ext in ['.jsinc', '.tzjs', '.html']:
-                rm(f)
-            if ext == '.js':
-                #Only remove canvas js files, might have js in root folder
-                (appname, target) = path_splitext(filename)
-                if target == '.canvas':
-                    rm(f)
+        with open(path, 'rb') as f:
+            data = f.read()
+        obj = json_loads(data)
+        if digits:
+            obj = _round_floats(obj, digits)
+        canonical = json_dumps(obj, separators=(',', ':'), sort_keys=sort_keys)
+        if canonical != data:
+            with open(path, 'wb') as f:
+                f.write(canonical)
+    except (IOError, ValueError) as e:
+        return (path, 0, 0, str(e))
+    return (path, len(data), len(canonical), None)
+
+def canonicalise_json_outputs(build_deps, env, options):
+    cache = load_cache(env, 'canonical')
+    tasks = [ ]
+    extensions = { }
+    for src, dest in build_deps.iteritems():
+        if not dest.endswith('.json') or not path_exists(dest):
+            continue
+        ext = path_splitext(src)[1]
+        digits = env['JSON_PRECISION'].get(ext)
+        settings = '%s:%s' % (digits, options.json_sort_keys)
+        cached = cache.get(dest)
+        if cached and cached[0] == settings and cached[1:] == file_stamp(dest):
+            continue
+        extensions[dest] = (ext, settings)
+        tasks.append((dest, digits, options.json_sort_keys))
+
+    if not tasks:
+        print 'All JSON outputs already canonical'
+        return
+
+    from multiprocessing import Pool
+
+    saved = { }
+    pool = Pool(int(options.threads))
+    try:
+        for (dest, before, after, e) in pool.imap_unordered(canonicalise_json, tasks):
+            (ext, settings) = extensions[dest]
+            if e:
+                warning('Failed to canonicalise %s: %s' % (dest, e))
+                continue
+            cache[dest] = [settings] + file_stamp(dest)
+            (count, total_before, total_after) = saved.get(ext, (0, 0, 0))
+            saved[ext] = (count + 1, total_before + before, total_after + after)
+    finally:
+        pool.close()
+        pool.join()
+    save_cache(env, 'canonical', cache)
+
+    for ext, (count, before, after) in sorted(saved.iteritems()):
+        print '{0:<12}{1:>6} files {2:>12} -> {3:>12} bytes (saved {4})'.format(ext, count, before, after, before - after)
+
+############################################################
+
+def asset_urn(src):
+    """The mapping table URN of an asset source path, matching gen_mapping."""
+    urn = src[len('assets/'):]
+    if '/' not in urn:
+        urn = './' + urn
+    return urn
+
+_DAE_REFERENCE = re.compile(r'<init_from>\s*([^<]+?)\s*</init_from>')
+_STRING_REFERENCE = re.compile(r'"((?:[^"\\\n]|\\.)+)"')
+
+REFERENCE_EXTENSIONS = {
+    '.dae': _DAE_REFERENCE,
+    '.material': _STRING_REFERENCE,
+    '.effect': _STRING_REFERENCE,
+    '.json': _STRING_REFERENCE
+}
+
+def extract_asset_references(src):
+    """Strings in an asset source that may name other assets."""
+    pattern = REFERENCE_EXTENSIONS.get(path_splitext(src)[1])
+    if pattern is None:
+        return [ ]
+    with open(src, 'rb') as f:
+        return sorted(set(pattern.findall(f.read())))
+
+def _reference_lookup(urn_mapping):
+    return dict((os.path.normpath(urn).replace('\\', '/'), urn) for urn in urn_mapping)
+
+def resolve_asset_reference(urn, reference, lookup):
+    """The URN a reference from an asset names, relative to the asset or to the asset root."""
+    reference = reference.replace('\\', '/')
+    if reference.startswith('file://'):
+        reference = reference[len('file://'):]
+    reference = reference.replace('%20', ' ')
+    if reference.startswith('assets/'):
+        reference = reference[len('assets/'):]
+    candidates = [path_join(path_split(urn)[0], reference), reference.lstrip('/')]
+    for candidate in candidates:
+        candidate = os.path.normpath(candidate).replace('\\', '/')
+        if candidate in lookup and lookup[candidate] != urn:
+            return lookup[candidate]
+    return None
+
+def _cached_references(src, cache):
+    stamp = file_stamp(src)
+    cached = cache.get(src)
+    if cached and cached[0] == stamp:
+        return cached[1]
+    references = extract_asset_references(src)
+    cache[src] = [stamp, references]
+    return references
+
+def asset_dependencies(build_deps, urn_mapping, env):
+    """Map each asset source to the sources of the assets it references, with cycles removed.
+
+    References are extracted from .dae, .material, .effect and .json sources and cached against
+    each source's size and modification time.
+    """
+    cache = load_cache(env, 'references')
+    lookup = _reference_lookup(urn_mapping)
+    graph = { }
+    for src in build_deps:
+        if path_splitext(src)[1] not in REFERENCE_EXTENSIONS:
+            continue
+        urn = asset_urn(src)
+        try:
+            references = _cached_references(src, cache)
+        except (IOError, OSError) as e:
+            warning('Failed to read references from %s: %s' % (src, e))
+            continue
+        deps = set()
+        for reference in references:
+            dep = resolve_asset_reference(urn, reference, lookup)
+            if dep:
+                deps.add(path_join('assets', os.path.normpath(dep)).replace('\\', '/'))
+        if deps:
+            graph[src] = deps
+            debug('deps:%s:%s' % (src, sorted(deps)))
+    save_cache(env, 'references', cache)
+
+    # Depth first walk, dropping the edges that close a cycle
+    acyclic = { }
+    state = { }
+    def _visit(src):
+        state[src] = 1
+        acyclic[src] = set()
+        for dep in sorted(graph.get(src, ())):
+            if state.get(dep) == 1:
+                warning('Dependency cycle: %s -> %s (ignored)' % (src, dep))
+                continue
+            acyclic[src].add(dep)
+            if dep not in state:
+                _visit(dep)
+        state[src] = 2
+    for src in sorted(graph):
+        if src not in state:
+            _visit(src)
+    return dict((src, deps) for src, deps in acyclic.iteritems() if deps)
+
+def apply_dependency_hashes(dependencies, build_deps, urn_mapping):
+    """Rename the targets of assets with dependencies to include their dependencies' targets.
+
+    Targets are immutable and named by hash, so an asset whose dependency changes needs a new
+    name for the change to reach the build and any cache of the old output.
+    """
+    renamed = { }
+    def _rename(src):
+        if src in renamed:
+            return
+        renamed[src] = True
+        deps = dependencies.get(src)
+        urn = asset_urn(src)
+        if not deps or src not in build_deps or urn not in urn_mapping:
+            return
+        for dep in deps:
+            _rename(dep)
+        (target_hash, suffix) = urn_mapping[urn].split('.', 1)
+        key = md5(target_hash)
+        for dep in sorted(deps):
+            key.update(urn_mapping.get(asset_urn(dep), ''))
+        target = '%s.%s' % (urlsafe_b64encode(key.digest()).strip('='), suffix)
+        urn_mapping[urn] = target
+        build_deps[src] = '%s/%s' % (path_split(build_deps[src])[0], target)
+    for src in sorted(dependencies):
+        _rename(src)
+
+def target_settings(src, dest, env, options):
+    """The build options that change an asset's output, as a string folded into its target name."""
+    settings = [ ]
+    if 'TEXTUREMIPS' in env and path_splitext(src)[1].lower() in TEXTUREMIPS.exts:
+        settings.append('mips:%s' % options.texture_filter)
+    if options.canonical_json and dest.endswith('.json'):
+        settings.append('canonical:%s:%s' % (env['JSON_PRECISION'].get(path_splitext(src)[1]), options.json_sort_keys))
+    if options.binary_geometry and path_splitext(src)[1] in GEOMETRY_EXTENSIONS:
+        settings.append('geometry:%s:%s:%s:%s' % (options.binary_geometry_threshold, options.quantise_positions,
+                                                   options.quantise_normals, options.quantise_uvs))
+    return ','.join(settings)
+
+def apply_settings_hashes(build_deps, urn_mapping, env, options):
+    """Rename the targets of assets whose output depends on build options to include the options.
+
+    Post-passes rewrite these outputs, so without a new name a changed option would leave the old
+    output in place for incremental builds and for any cache of the old output.
+    """
+    for src in sorted(build_deps):
+        urn = asset_urn(src)
+        settings = target_settings(src, build_deps[src], env, options)
+        if not settings or urn not in urn_mapping:
+            continue
+        (target_hash, suffix) = urn_mapping[urn].split('.', 1)
+        target = '%s.%s' % (urlsafe_b64encode(md5(target_hash + settings).digest()).strip('='), suffix)
+        urn_mapping[urn] = target
+        build_deps[src] = '%s/%s' % (path_split(build_deps[src])[0], target)
+
+def add_dependents(build_deps, urn_mapping, env, ignore, deleted=None):
+    """Add the previously built assets that reference the selected (or deleted) assets, transitively."""
+    from genmapping import gen_mapping
+
+    cache = load_cache(env, 'references')
+    lookup = _reference_lookup(urn_mapping)
+    for src in deleted or [ ]:
+        lookup.setdefault(asset_urn(src), asset_urn(src))
+    changed = set(asset_urn(src) for src in build_deps.keys() + (deleted or [ ]))
+    while True:
+        dependents = [src for src, (_, references) in cache.iteritems()
+                      if src not in build_deps and path_exists(src) and
+                      any(resolve_asset_reference(asset_urn(src), r, lookup) in changed for r in references)]
+        if not dependents:
+            break
+        (dependents_obj, dependents_deps) = gen_mapping('assets', 'staticmax', ignore,
+                                                        files=[src[len('assets/'):] for src in dependents])
+        urn_mapping.update(dependents_obj['urnmapping'])
+        build_deps.update(dependents_deps)
+        changed.update(dependents_obj['urnmapping'])
+        lookup.update(_reference_lookup(dependents_obj['urnmapping']))
+        if not dependents_deps:
+            break
+
+def schedule_assets(assets, dependencies, build, num_threads):
+    """Call build(src) for each asset on a pool of threads, once all its dependencies are built."""
+    if not assets:
+        return
+    pending = set(assets)
+    waiting = { }
+    dependents = { }
+    for src in assets:
+        deps = [dep for dep in dependencies.get(src, ()) if dep in pending]
+        waiting[src] = len(deps)
+        for dep in deps:
+            dependents.setdefault(dep, [ ]).append(src)
+
+    from Queue import Queue
+    ready = Queue()
+    for src in assets:
+        if not waiting[src]:
+            ready.put(src)
+
+    lock = Lock()
+    remaining = [len(assets)]
+    num_threads = max(1, min(num_threads, len(assets)))
+
+    def _worker():
+        while True:
+            src = ready.get()
+            if src is None:
+                return
+            try:
+                build(src)
+            except Exception as e:
+                error('Failed to build %s: %s' % (src, e))
+            with lock:
+                remaining[0] -= 1
+                for dependent in dependents.get(src, [ ]):
+                    waiting[dependent] -= 1
+                    if not waiting[dependent]:
+                        ready.put(dependent)
+                if not remaining[0]:
+                    for _ in xrange(num_threads):
+                        ready.put(None)
+
+    threads = [Thread(target=_worker) for _ in xrange(num_threads)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+############################################################
+
+class BuildMetrics(object):
+    """Thread-safe asset build counters, rendered as Prometheus text metrics."""
+
+    LATENCY_BUCKETS = [0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300]
+    RESULTS = ['built', 'skipped', 'failed']
+
+    def __init__(self, total):
+        self.lock = Lock()
+        self.start = time()
+        self.total = total
+        self.queued = total
+        self.running = 0
+        self.results = dict((result, 0) for result in self.RESULTS)
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.latency = { }
+
+    def started(self):
+        with self.lock:
+            self.queued -= 1
+            self.running += 1
+
+    def finished(self, tool, result, seconds, bytes_in, bytes_out):
+        with self.lock:
+            self.running -= 1
+            self.results[result] += 1
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+            if result != 'skipped':
+                (buckets, total, count) = self.latency.get(tool, ([0] * len(self.LATENCY_BUCKETS), 0.0, 0))
+                buckets = [n + (seconds <= bound) for n, bound in zip(buckets, self.LATENCY_BUCKETS)]
+                self.latency[tool] = (buckets, total + seconds, count + 1)
+
+    def done(self):
+        return sum(self.results.itervalues())
+
+    def eta(self):
+        done = self.done()
+        if not done:
+            return None
+        return (time() - self.start) / done * (self.total - done)
+
+    def render(self):
+        with self.lock:
+            lines = ['# TYPE tzbuild_tasks gauge']
+            lines.append('tzbuild_tasks{state="queued"} %i' % self.queued)
+            lines.append('tzbuild_tasks{state="running"} %i' % self.running)
+            lines.append('# TYPE tzbuild_tasks_done_total counter')
+            for result in self.RESULTS:
+                lines.append('tzbuild_tasks_done_total{result="%s"} %i' % (result, self.results[result]))
+            lines.append('# TYPE tzbuild_bytes_in_total counter')
+            lines.append('tzbuild_bytes_in_total %i' % self.bytes_in)
+            lines.append('# TYPE tzbuild_bytes_out_total counter')
+            lines.append('tzbuild_bytes_out_total %i' % self.bytes_out)
+            lines.append('# TYPE tzbuild_tool_duration_seconds histogram')
+            for tool, (buckets, total, count) in sorted(self.latency.iteritems()):
+                for bound, n in zip(self.LATENCY_BUCKETS, buckets):
+                    lines.append('tzbuild_tool_duration_seconds_bucket{tool="%s",le="%g"} %i' % (tool, bound, n))
+                lines.append('tzbuild_tool_duration_seconds_bucket{tool="%s",le="+Inf"} %i' % (tool, count))
+                lines.append('tzbuild_tool_duration_seconds_sum{tool="%s"} %f' % (tool, total))
+                lines.append('tzbuild_tool_duration_seconds_count{tool="%s"} %i' % (tool, count))
+        eta = self.eta()
+        if eta is not None:
+            lines.append('# TYPE tzbuild_eta_seconds gauge')
+            lines.append('tzbuild_eta_seconds %f' % eta)
+        return '\n'.join(lines) + '\n'
+
+    def progress(self, width=30):
+        done = self.done()
+        filled = width * done / max(self.total, 1)
+        eta = self.eta()
+        return '[%s%s] %i/%i built: %i skipped: %i failed: %i ETA: %s' % (
+            '#' * filled, '-' * (width - filled), done, self.total,
+            self.results['built'], self.results['skipped'], self.results['failed'],
+            '%is' % eta if eta is not None else '?')
+
+def start_metrics_server(metrics, port):
+    """Serve the build metrics on localhost from a daemon thread."""
+    import socket
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = metrics.render()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            debug('metrics: ' + format % args)
+
+    try:
+        server = HTTPServer(('127.0.0.1', port), MetricsHandler)
+    except socket.error as e:
+        error('Failed to serve build metrics on port %i (continuing without): %s' % (port, e))
+        return None
+    thread = Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    info('Serving build metrics on http://127.0.0.1:%i/metrics' % port)
+    return server
+
+class ProgressBar(object):
+    """Single console line redrawn at most every interval seconds."""
+
+    def __init__(self, metrics, interval=0.2):
+        self.metrics = metrics
+        self.interval = interval
+        self.lock = Lock()
+        self.last = 0
+
+    def update(self, force=False):
+        with self.lock:
+            now = time()
+            if force or now - self.last >= self.interval:
+                self.last = now
+                sys.stdout.write('\r' + self.metrics.progress())
+                sys.stdout.flush()
+
+    def finish(self):
+        self.update(True)
+        sys.stdout.write('\n')
+
+def changed_assets(rev):
+    """Asset paths, relative to 'assets', changed or added since a git revision."""
+    # Without rename detection a moved asset lists both paths, so its old URN is dropped
+    changed = exec_command(['git', 'diff', '--name-only', '--no-renames', '--relative', rev, '--', 'assets'],
+                           shell=False)
+    untracked = exec_command(['git', 'ls-files', '--others', '--exclude-standard', '--', 'assets'], shell=False)
+    paths = set()
+    for path in (changed or '').splitlines() + (untracked or '').splitlines():
+        path = path.strip().replace('\\', '/')
+        if path.startswith('assets/'):
+            paths.add(path[len('assets/'):])
+    return sorted(paths)
+
+def gen_partial_mapping(env, options, ignore):
+    """Map only the assets selected by --only and --since, merged into the existing mapping table."""
+    from genmapping import gen_mapping, normalise_globs
+
+    files = None
+    deleted = [ ]
+    if options.since:
+        files = changed_assets(options.since)
+        deleted = [f for f in files if not path_exists(path_join('assets', f))]
+    (partial_obj, build_deps) = gen_mapping('assets', 'staticmax', ignore, only=options.only, files=files)
+    partial_mapping = partial_obj['urnmapping']
+
+    if path_exists(env['APP_MAPPING_TABLE']):
+        with open(env['APP_MAPPING_TABLE'], 'r') as f:
+            mapping_table_obj = json_load(f)
+    else:
+        mapping_table_obj = { 'urnmapping': { } }
+    urn_mapping = mapping_table_obj['urnmapping']
+
+    if options.only:
+        globs = normalise_globs('assets', options.only)
+        deleted = [f for f in deleted if any(fnmatch(f, g) for g in globs)]
+        if not options.since:
+            # Everything under the selection was walked, so mapped assets not found are deleted.
+            # Atlases and geometry buffers are generated, not sources.
+            generated = set('textures/%s.atlas.json' % atlas_dir.strip('/') for atlas_dir in env['ATLAS_DIRS'])
+            for urn in urn_mapping:
+                if urn in partial_mapping or urn in generated or \
+                   (urn.endswith('.bin') and urn[:-len('.bin')] in urn_mapping):
+                    continue
+                path = urn[len('./'):] if urn.startswith('./') else urn
+                if any(fnmatch(path, g) for g in globs):
+                    deleted.append(path)
+    deleted = [asset_urn(path_join('assets', f)) for f in deleted]
+
+    # Atlases are packed from every image in their directory
+    for atlas_dir in env['ATLAS_DIRS']:
+        prefix = 'textures/%s/' % atlas_dir.strip('/')
+        if any(urn.startswith(prefix) for urn in partial_mapping.keys() + deleted):
+            (atlas_obj, atlas_deps) = gen_mapping('assets', 'staticmax', ignore, only=[prefix + '*'])
+            partial_mapping.update(atlas_obj['urnmapping'])
+            build_deps.update(atlas_deps)
+
+    for urn in deleted:
+        info('Removing deleted asset from mapping table: %s' % urn)
+        for mapping in mapping_table_obj.itervalues():
+            mapping.pop(urn, None)
+            # and its binary geometry buffer
+            mapping.pop(urn + '.bin', None)
+    urn_mapping.update(partial_mapping)
+
+    add_dependents(build_deps, urn_mapping, env, ignore,
+                   [path_join('assets', urn) for urn in deleted])
+
+    print '%i of %i assets selected' % (len(build_deps), len(urn_mapping))
+    return (mapping_table_obj, build_deps)
+
+PREFLIGHT_MAX_SIZE = 1 << 30
+
+PREFLIGHT_MAGIC = {
+    '.png': '\x89PNG\r\n\x1a\n',
+    '.jpg': '\xff\xd8\xff',
+    '.jpeg': '\xff\xd8\xff',
+    '.dds': 'DDS ',
+    '.ogg': 'OggS'
+}
+
+PREFLIGHT_MIN_SIZE = {
+    '.tga': 18
+}
+
+PREFLIGHT_JSON = ['.json', '.material', '.effect']
+PREFLIGHT_XML = ['.xml', '.dae']
+
+# JSON sources larger than this are scanned rather than parsed, so workers never hold them whole
+PREFLIGHT_JSON_PARSE_SIZE = 16 << 20
+PREFLIGHT_JSON_CHUNK = 1 << 20
+_JSON_SPECIAL = re.compile(r'[\[\]{}"\\]')
+
+def _preflight_json_scan(src):
+    """Streaming check of a JSON file: valid UTF-8, terminated strings and balanced brackets."""
+    from codecs import getincrementaldecoder
+
+    decoder = getincrementaldecoder('utf-8')()
+    opening = { ']': '[', '}': '{' }
+    stack = [ ]
+    in_string = False
+    escaped = False
+    with open(src, 'rb') as f:
+        while True:
+            data = f.read(PREFLIGHT_JSON_CHUNK)
+            text = decoder.decode(data, final=not data)
+            if not text and data:
+                continue
+            # Skip the first character of this chunk if it was escaped at the end of the last
+            escape_end = 1 if escaped else 0
+            escaped = False
+            for match in _JSON_SPECIAL.finditer(text):
+                pos = match.start()
+                if pos < escape_end:
+                    continue
+                c = match.group()
+                if in_string:
+                    if c == '\\':
+                        escape_end = pos + 2
+                        escaped = escape_end > len(text)
+                    elif c == '"':
+                        in_string = False
+                elif c == '"':
+                    in_string = True
+                elif c in '[{':
+                    stack.append(c)
+                elif c in ']}':
+                    if not stack or stack.pop() != opening[c]:
+                        raise ValueError('unbalanced %s' % c)
                 else:
-                    warning('[Warning] target %s unknown, ignoring. Not cleaned: %s' % (target, f))
+                    raise ValueError('backslash outside a string')
+            if not data:
+                break
+    if in_string:
+        raise ValueError('unterminated string')
+    if stack:
+        raise ValueError('unclosed %s' % stack[-1])
+
+def preflight_check(src):
+    """Cheap structural check of an asset source; runs in a worker process.
+
+    Returns (src, problem) with problem None when the source looks sound.
+    """
+    from xml.etree.cElementTree import iterparse, ParseError
+
+    ext = path_splitext(src)[1].lower()
+    try:
+        size = os.path.getsize(src)
+        if size == 0:
+            return (src, 'empty file')
+        if size > PREFLIGHT_MAX_SIZE:
+            return (src, 'larger than %i bytes' % PREFLIGHT_MAX_SIZE)
+        if size < PREFLIGHT_MIN_SIZE.get(ext, 0):
+            return (src, 'truncated (%i bytes)' % size)
+
+        if ext in PREFLIGHT_MAGIC:
+            magic = PREFLIGHT_MAGIC[ext]
+            with open(src, 'rb') as f:
+                if f.read(len(magic)) != magic:
+                    return (src, 'unexpected file header for %s' % ext)
+        elif ext in PREFLIGHT_JSON:
+            if size > PREFLIGHT_JSON_PARSE_SIZE:
+                _preflight_json_scan(src)
+            else:
+                with open(src, 'rb') as f:
+                    json_load(f)
+        elif ext in PREFLIGHT_XML:
+            # Stream the file: drop each element once parsed so the tree is never built
+            root = None
+            for (event, elem) in iterparse(src, events=('start', 'end')):
+                if root is None:
+                    root = elem
+                elif event == 'end':
+                    elem.clear()
+                    root.clear()
+    except (IOError, OSError, ValueError, ParseError, SyntaxError) as e:
+        return (src, str(e) or e.__class__.__name__)
+    return (src, None)
+
+def preflight(build_deps, env, options):
+    """Check every asset source in parallel, reusing results for unchanged sources. Returns the problems."""
+    cache = load_cache(env, 'preflight')
+    problems = { }
+    sources = [ ]
+    for src in build_deps:
+        cached = cache.get(src)
+        if cached and path_exists(src) and cached[0] == file_stamp(src):
+            if cached[1]:
+                problems[src] = cached[1]
+        else:
+            sources.append(src)
+
+    if sources:
+        from multiprocessing import Pool
+        pool = Pool(int(options.threads))
+        try:
+            for (src, problem) in pool.imap_unordered(preflight_check, sources, chunksize=64):
+                if path_exists(src):
+                    cache[src] = [file_stamp(src), problem]
+                if problem:
+                    problems[src] = problem
+        finally:
+            pool.close()
+            pool.join()
+        save_cache(env, 'preflight', cache)
+
+    for src in sorted(problems):
+        warning('%s: %s' % (src, problems[src]))
+    print '%i sources checked (%i cached), %i problems' % (len(build_deps), len(build_deps) - len(sources), len(problems))
+    return problems
+
+EMPTY_TRASH = 'import sys, shutil; [shutil.rmtree(path, True) for path in sys.argv[1:]]'
+
+def move_to_trash(path, env):
+    """Rename a directory into the trash, so it is gone at once. empty_trash() deletes it later.
+
+    Falls back to removing it in place if it can't be renamed (e.g. a file in it is open on Windows).
+    """
+    if not path_isdir(path):
+        return
+    mkdir(env['APP_TRASH'])
+    trash = path_join(env['APP_TRASH'], '%s.%i.%i' % (path_basename(path), os.getpid(), time() * 1000))
+    try:
+        os.rename(path, trash)
+        debug('trash: %s -> %s' % (path, trash))
+    except OSError as e:
+        warning('Failed to move %s to the trash (%s), removing it now' % (path, e))
+        rmdir(path)
+
+def empty_trash(env):
+    """Delete everything in the trash from a detached process, including anything left by an interrupted clean."""
+    trash = env['APP_TRASH']
+    if path_isdir(trash):
+        entries = [path_join(trash, f) for f in os.listdir(trash)]
+        if entries:
+            debug('Emptying trash: %s' % entries)
+            exec_command([sys.executable, '-c', EMPTY_TRASH] + entries, shell=False, wait=False)
+
+def clean(env, assets=True, code=True):
+    try:
+        if assets:
+            from mappingpaths import mapping_table_paths
+            move_to_trash(env['APP_STATICMAX'], env)
+            rm(env['APP_MAPPING_TABLE'])
+            mapping_paths = mapping_table_paths(env['APP_MAPPING_TABLE'])
+            rm(mapping_paths['index'])
+            rm(mapping_paths['binary'])
+            move_to_trash(mapping_paths['shards'], env)
+
+        if code:
+            # Aggressive root level cleaning
+            for f in os.listdir(env['APP_ROOT']):
+                (filename, ext) = path_splitext(f)
+
+                # Also cleans previous SDK content e.g. .jsinc
+                if ext in ['.jsinc', '.tzjs', '.html'] or f.endswith('.preload.json'):
+                    rm(f)
+                if ext == '.js':
+                    #Only remove canvas js files, might have js in root folder
+                    (appname, target) = path_splitext(filename)
+                    if target == '.canvas':
+                        rm(f)
+                    else:
+                        warning('[Warning] target %s unknown, ignoring. Not cleaned: %s' % (target, f))
+
+        empty_trash(env)
     except OSError as e:
         error('Failed to remove: %s' % str(e))
         return False
 
     return True
 
+############################################################
+
+def _code_output(filename):
+    ext = path_splitext(filename)[1]
+    return ext in ['.jsinc', '.tzjs', '.html'] or filename.endswith('.canvas.js') or filename.endswith('.preload.json')
+
+def build_outputs(env):
+    """Paths, relative to the app root, of everything the build writes for deployment."""
+    from mappingpaths import mapping_table_paths
+
+    outputs = [ ]
+    for root, _, files in os.walk(env['APP_STATICMAX']):
+        for f in files:
+            outputs.append(os.path.relpath(path_join(root, f), env['APP_ROOT']))
+
+    mapping_paths = mapping_table_paths(env['APP_MAPPING_TABLE'])
+    for path in [env['APP_MAPPING_TABLE'], mapping_paths['index'], mapping_paths['binary']]:
+        if path_exists(path):
+            outputs.append(os.path.relpath(path, env['APP_ROOT']))
+    for root, _, files in os.walk(mapping_paths['shards']):
+        for f in files:
+            outputs.append(os.path.relpath(path_join(root, f), env['APP_ROOT']))
+
+    outputs.extend(f for f in os.listdir(env['APP_ROOT']) if _code_output(f))
+    return sorted(path.replace('\\', '/') for path in outputs)
+
+def _file_md5(path):
+    digest = md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), ''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def package_delta(env, options):
+    """Write a manifest of all outputs and an archive of the outputs missing from the previous manifest."""
+    previous = { }
+    if path_exists(options.package_delta):
+        with open(options.package_delta, 'r') as f:
+            previous = json_load(f).get('files', { })
+    else:
+        warning('Previous manifest not found, packaging everything: %s' % options.package_delta)
+
+    # Staticmax outputs are immutable so their hashes are cached against size and mtime
+    cache = load_cache(env, 'package')
+    manifest = { }
+    for path in build_outputs(env):
+        stamp = file_stamp(path)
+        cached = cache.get(path)
+        if cached and cached[0] == stamp:
+            digest = cached[1]
+        else:
+            digest = _file_md5(path)
+            cache[path] = [stamp, digest]
+        manifest[path] = { 'size': stamp[0], 'hash': digest }
+    save_cache(env, 'package', cache)
+
+    changed = [path for path in sorted(manifest)
+               if previous.get(path, { }).get('hash') != manifest[path]['hash']]
+
+    mkdir(options.package_dir)
+    manifest_path = path_join(options.package_dir, 'manifest.json')
+    with open(manifest_path, 'w') as f:
+        json_dump({ 'version': 1, 'files': manifest }, f, separators=(',', ':'), sort_keys=True)
+
+    if options.package_format == 'zip':
+        from zipfile import ZipFile, ZIP_DEFLATED
+        archive_path = path_join(options.package_dir, 'delta.zip')
+        with ZipFile(archive_path, 'w', ZIP_DEFLATED, allowZip64=True) as archive:
+            for path in changed:
+                archive.write(path)
+    else:
+        archive_path = path_join(options.package_dir, 'delta.tar.gz')
+        from tarfile import open as tar_open
+        archive = tar_open(archive_path, 'w|gz')
+        try:
+            for path in changed:
+                archive.add(path)
+        finally:
+            archive.close()
+
+    print '%i outputs -> %s' % (len(manifest), manifest_path)
+    print '%i new or changed (%i bytes) -> %s' % (len(changed), sum(manifest[p]['size'] for p in changed), archive_path)
+    return True
+
 def find_non_ascii(path, env):
     non_ascii_count = 0
     for root, dirs, files in os.walk(path):
@@ -738,19 +2506,101 @@ def find_non_ascii(path, env):
 
 ############################################################
 
+STARTUP_TARGET = 0.1
+
+def benchmark_startup(runs):
+    """Time fresh interpreters running commands that should not load the SDK or heavy modules."""
+    commands = [['--help'], ['--find-non-ascii']]
+    slow = False
+    for args in commands:
+        timings = [ ]
+        for _ in xrange(runs):
+            start = time()
+            exec_command([sys.executable, path_abspath(__file__)] + args, shell=False, ignore=True)
+            timings.append(time() - start)
+        best = min(timings)
+        slow = slow or best > STARTUP_TARGET
+        print '%-20s min %6.1fms mean %6.1fms%s' % (' '.join(args), best * 1000, sum(timings) * 1000 / runs,
+                                                  ' (over %ims)' % (STARTUP_TARGET * 1000)
+                                                  if best > STARTUP_TARGET else '')
+    return 1 if slow else 0
+
+############################################################
+
 def main():
     parser = OptionParser()
     parser.add_option('--clean', action='store_true', default=False, help="Clean build output")
+    parser.add_option('--clean-assets', action='store_true', default=False,
+                      help="Clean only the asset build output (staticmax and the mapping table)")
+    parser.add_option('--clean-code', action='store_true', default=False,
+                      help="Clean only the code build output, keeping built assets")
     parser.add_option('--assets', action='store_true', default=False, help="Build assets")
     parser.add_option('--code', action='store_true', default=False, help="Build code")
     parser.add_option('--all', action='store_true', default=False, help="Build everything")
 
+    parser.add_option('--preflight', action='store_true', default=False,
+                      help="Check asset sources for structural problems before converting them")
+    parser.add_option('--preflight-abort', action='store_true', default=False,
+                      help="Check asset sources before converting them and stop if any have problems")
+    parser.add_option('--only', action='append', default=[],
+                      help="Only build assets matching this glob or directory (relative to assets/), "
+                           "merging into the existing mapping table")
+    parser.add_option('--since', default=None,
+                      help="Only build assets changed since this git revision, "
+                           "merging into the existing mapping table")
+
+    parser.add_option('--package-delta', default=None, metavar='PREVIOUS_MANIFEST',
+                      help="Write a manifest of all outputs and an archive of those not in the previous manifest")
+    parser.add_option('--package-dir', default='package', help="Output directory for --package-delta")
+    parser.add_option('--package-format', type='choice', choices=['tar', 'zip'], default='tar',
+                      help="Archive format for --package-delta: tar (gzipped) or zip")
+
     parser.add_option('--find-non-ascii', action='store_true', default=False,
                       help="Searches for non ascii characters in the scripts")
     parser.add_option('--template', dest='templateName', help="Specify the template to build")
+    parser.add_option('--variants', default=None,
+                      help="Comma separated code outputs to build, e.g. canvas.release.html (default: all)")
+    parser.add_option('--preload-manifest', action='store_true', default=False,
+                      help="Also write <template>.preload.json listing the assets each template loads")
     parser.add_option('--closure', default=None, help="Path to Closure")
     parser.add_option('--yui', default=None, help="Path to YUI")
     parser.add_option('--threads', default=4, help="Number of threads to use")
+    parser.add_option('--atlas', action='append', default=[],
+                      help="Pack the .png files in this directory under assets/textures into atlases")
+    parser.add_option('--obj-converter', type='choice', choices=['sdk', 'native'], default='sdk',
+                      help="Converter used for .obj assets: sdk (obj2json) or native (in-process, requires numpy)")
+    parser.add_option('--compare-obj', action='store_true', default=False,
+                      help="Convert each .obj asset with both converters, compare the output and report timings")
+    parser.add_option('--binary-geometry', action='store_true', default=False,
+                      help="Move large vertex and index arrays of mesh outputs into binary buffers (requires numpy)")
+    parser.add_option('--binary-geometry-threshold', default=256,
+                      help="Minimum array length moved into a binary buffer")
+    parser.add_option('--quantise-positions', type='choice', choices=['0', '8', '16'], default='0',
+                      help="Quantise positions in binary buffers to 8 or 16 bits (0 keeps float32)")
+    parser.add_option('--quantise-normals', type='choice', choices=['0', '8', '16'], default='0',
+                      help="Quantise normals, tangents and binormals in binary buffers to 8 or 16 bits")
+    parser.add_option('--quantise-uvs', type='choice', choices=['0', '8', '16'], default='0',
+                      help="Quantise texture coordinates in binary buffers to 8 or 16 bits")
+    parser.add_option('--canonical-json', action='store_true', default=False,
+                      help="Minify JSON outputs, optionally rounding floats and sorting keys")
+    parser.add_option('--json-precision', action='append', default=[],
+                      help="Significant digits kept for floats in JSON built from an extension, e.g. .dae=6")
+    parser.add_option('--json-sort-keys', action='store_true', default=False,
+                      help="Sort keys when canonicalising JSON outputs")
+    parser.add_option('--texture-mips', action='store_true', default=False,
+                      help="Resize .png/.jpg/.tga textures to power-of-two and generate mip chains (requires numpy and PIL)")
+    parser.add_option('--texture-filter', type='choice', choices=['box', 'lanczos'], default='box',
+                      help="Filter used to generate mip levels: box or lanczos")
+    parser.add_option('--shard-mapping', action='store_true', default=False,
+                      help="Also write the mapping table sharded by top-level asset directory")
+    parser.add_option('--binary-mapping', action='store_true', default=False,
+                      help="Also write a memory-mappable binary mapping table")
+    parser.add_option('--metrics-port', default=None,
+                      help="Serve Prometheus text metrics for the asset build on this localhost port")
+    parser.add_option('--progress', action='store_true', default=False,
+                      help="Show a progress bar instead of a line per asset")
+    parser.add_option('--benchmark-startup', default=None, metavar='RUNS',
+                      help="Time how long this script takes to start for --help and --find-non-ascii")
     parser.add_option('--verbose', action='store_true', help="Prints additional information about the build process")
     (options, args) = parser.parse_args()
 
@@ -759,13 +2609,32 @@ def main():
     else:
         logging_config(format='[%(levelname)s] %(message)s')
 
+    if options.benchmark_startup:
+        return benchmark_startup(int(options.benchmark_startup))
+
     env = {}
 
-    _log_stage('CONFIGURING')
-    if not configure(env, options):
+    if not configure_paths(env, options):
         error('Failed to configure build')
         return 1
 
+    # Only look for the SDK tools the requested stages use
+    tool_classes = [ ]
+    if options.assets or options.all or options.compare_obj:
+        tool_classes.extend(ASSET_TOOLS)
+        if options.obj_converter == 'native' or options.compare_obj:
+            tool_classes.append(NATIVEOBJ2JSON)
+        if options.texture_mips:
+            tool_classes.append(TEXTUREMIPS)
+    if options.code or options.all:
+        tool_classes.extend(CODE_TOOLS)
+
+    if tool_classes and not options.find_non_ascii:
+        _log_stage('CONFIGURING')
+        if not configure(env, options, tool_classes):
+            error('Failed to configure build')
+            return 1
+
     if options.find_non_ascii:
         _log_stage('NON-ASCII CHARACTERS')
         count = find_non_ascii(env['APP_SCRIPTS'], env)
@@ -775,9 +2644,13 @@ def main():
             info("Only ASCII found!")
         return count
 
-    if options.clean:
+    if options.compare_obj:
+        _log_stage('COMPARING OBJ CONVERTERS')
+        return compare_obj_converters(env, options)
+
+    if options.clean or options.clean_assets or options.clean_code:
         _log_stage('CLEANING')
-        success = clean(env)
+        success = clean(env, assets=options.clean or options.clean_assets, code=options.clean or options.clean_code)
         if not success:
             error('Failed to clean build')
             return 1
@@ -787,69 +2660,151 @@ def main():
     if options.assets or options.all:
         _log_stage("ASSET BUILD (may be slow - only build code with --code)")
 
+        if options.binary_geometry and not load_numpy():
+            error('Binary geometry buffers require numpy')
+            return 1
+        if options.texture_mips and 'TEXTUREMIPS' not in env:
+            error('--texture-mips could not be configured, not building assets')
+            return 1
+
         # Mapping table
         mkdir('staticmax')
-        (mapping_table_obj, build_deps) = gen_mapping('assets', 'staticmax',
-            ['.pdf', '.mtl', '.otf', '.txt', '.cgh', '.mb'])
+        ignore_exts = ['.pdf', '.mtl', '.otf', '.txt', '.cgh', '.mb']
+        if options.only or options.since:
+            try:
+                (mapping_table_obj, build_deps) = gen_partial_mapping(env, options, ignore_exts)
+            except CalledProcessError as e:
+                error('Failed to find changed assets: %s' % e)
+                return 1
+        else:
+            from genmapping import gen_mapping
+            (mapping_table_obj, build_deps) = gen_mapping('assets', 'staticmax', ignore_exts)
         debug('assets:src:%s' % build_deps)
         urn_mapping = mapping_table_obj['urnmapping']
 
+        if options.preflight or options.preflight_abort:
+            _log_stage('PREFLIGHT')
+            if preflight(build_deps, env, options) and options.preflight_abort:
+                error('Asset sources have problems, not building')
+                return 1
+
+        if env['ATLAS_DIRS']:
+            build_atlases(env, options, mapping_table_obj, build_deps)
+
+        if 'TEXTUREMIPS' in env:
+            mip_mapping = mapping_table_obj.setdefault('mipmapping', { })
+
+        # Outputs rewritten by post-passes are named by the options used
+        apply_settings_hashes(build_deps, urn_mapping, env, options)
+
+        # Dependent assets are renamed when anything they reference changes
+        dependencies = asset_dependencies(build_deps, urn_mapping, env)
+        apply_dependency_hashes(dependencies, build_deps, urn_mapping)
+
         def _write_mapping_table():
+            from genmapping import write_mapping_table
             print '%i assets -> %s' % (len(urn_mapping), env['MAPPING_TABLE'])
-            with open(env['APP_MAPPING_TABLE'], 'w') as f:
-                json_dump(mapping_table_obj, f, separators=(',', ':'))
+            write_mapping_table(mapping_table_obj, env['APP_MAPPING_TABLE'],
+                                shard=options.shard_mapping, binary=options.binary_mapping)
 
         # Write mapping table
         _write_mapping_table()
 
-        longest = len(max(build_deps, key=len)) + 2
+        if 'TEXTUREMIPS' in env:
+            env['TEXTUREMIPS'].start(options)
+
+        metrics = BuildMetrics(len(build_deps))
+        metrics_server = start_metrics_server(metrics, int(options.metrics_port)) if options.metrics_port else None
+        progress = ProgressBar(metrics) if options.progress else None
+
+        longest = max([len(src) for src in build_deps] or [0]) + 2
         def _log(src, dest, skipping=False):
+            if progress:
+                return
             msg = '(skipping) ' if skipping else ''
             print '{0:-<{longest}}> {2}{1}'.format(src + ' ', dest, msg, longest=longest)
 
-        metrics = dict(built=0, skipped=0, failed=0)
+        def _tool_name(src):
+            ext = path_splitext(src)[1]
+            tool = env['TOOLS'].get(ext)
+            if tool:
+                return tool.name
+            return 'COPY' if ext in env['COPY_EXTENSIONS'] else 'NONE'
+
         def build(src):
             dest = build_deps[src]
-            if path_exists(dest):
-                _log(src, dest, True)
-                metrics['skipped'] += 1
-            else:
-                _log(src, dest)
-                success = build_asset(src, dest, env, options)
-                if not success:
-                    # Bit of a hack to remove the failed asset from the mapping table.
-                    asset = src[len('assets/'):]
-                    del urn_mapping[asset]
-                    info('Removing asset from mapping table: %s' % asset)
-                    metrics['failed'] += 1
+            metrics.started()
+            start = time()
+            result = 'failed'
+            try:
+                if path_exists(dest):
+                    _log(src, dest, True)
+                    result = 'skipped'
                 else:
-                    metrics['built'] += 1
-
-        class Builder(Thread):
-            def __init__(self, assets):
-                Thread.__init__(self)
-                self.assets = assets
-
-            def run(self):
-                map(build, self.assets)
-
-        assets = build_deps.keys()
-        num_threads = int(options.threads)
-        threads = [Builder(assets[i::num_threads]) for i in range(num_threads)]
-        for t in threads:
-            t.start()
-        for t in threads:
-            t.join()
-        else:
-            del threads
+                    _log(src, dest)
+                    success = build_asset(src, dest, env, options)
+                    if not success:
+                        # Bit of a hack to remove the failed asset from the mapping table.
+                        asset = asset_urn(src)
+                        urn_mapping.pop(asset, None)
+                        info('Removing asset from mapping table: %s' % asset)
+                        result = 'failed'
+                    else:
+                        result = 'built'
+
+                if 'TEXTUREMIPS' in env and path_splitext(src)[1].lower() in TEXTUREMIPS.exts and path_exists(dest):
+                    try:
+                        mip_mapping[asset_urn(src)] = env['TEXTUREMIPS'].levels(options, src)[1:]
+                    except (IOError, ValueError) as e:
+                        error('Failed to generate mips for %s: %s' % (src, e))
+
+                if options.binary_geometry and path_splitext(src)[1] in GEOMETRY_EXTENSIONS and path_exists(dest):
+                    try:
+                        urn_mapping.update(pack_geometry_buffers(asset_urn(src), dest, options))
+                    except (IOError, ValueError) as e:
+                        error('Failed to pack geometry buffers for %s: %s' % (src, e))
+            finally:
+                # Always balance started(), even if building raised
+                bytes_in = os.path.getsize(src) if path_exists(src) else 0
+                bytes_out = os.path.getsize(dest) if result == 'built' and path_exists(dest) else 0
+                metrics.finished(_tool_name(src), result, time() - start, bytes_in, bytes_out)
+                if progress:
+                    progress.update()
+
+        schedule_assets(build_deps.keys(), dependencies, build, int(options.threads))
+        if progress:
+            progress.finish()
+        if metrics_server:
+            metrics_server.shutdown()
+        if 'TEXTUREMIPS' in env:
+            env['TEXTUREMIPS'].finish(env)
+
+        if options.canonical_json:
+            _log_stage('CANONICALISING JSON')
+            canonicalise_json_outputs(build_deps, env, options)
 
         # Write mapping table
         _write_mapping_table()
 
-        _log_stage("BUILT: %i - SKIPPED: %i - FAILED: %i" % (metrics['built'], metrics['skipped'], metrics['failed']))
+        _log_stage("BUILT: %i - SKIPPED: %i - FAILED: %i" % (metrics.results['built'], metrics.results['skipped'],
+                                                             metrics.results['failed']))
 
     if options.code or options.all:
         _log_stage('CODE BUILD')
+        if options.variants:
+            variant_names = options.variants.split(',')
+        elif 'USER_CODE_VARIANTS' in globals():
+            variant_names = USER_CODE_VARIANTS
+        else:
+            variant_names = list(CODE_VARIANTS)
+        if options.preload_manifest:
+            variant_names = list(variant_names) + ['.preload.json']
+        try:
+            code_variants = select_code_variants(variant_names)
+        except ValueError as e:
+            error(str(e))
+            return 1
+
         if options.templateName:
             code_files = ['%s.js' % path_join('templates', options.templateName)]
         else:
@@ -858,24 +2813,27 @@ def main():
 
         for src in code_files:
             (code_base, code_ext) = path_splitext(path_split(src)[1])
-            code_dests = [ code_base + ".canvas.debug.html",
-                           code_base + ".canvas.release.html",
-                           code_base + ".canvas.default.debug.html",
-                           code_base + ".canvas.default.release.html",
-                           code_base + ".canvas.js",
-                           code_base + ".debug.html",
-                           code_base + ".release.html",
-                           code_base + ".default.debug.html",
-                           code_base + ".default.release.html",
-                           code_base + ".tzjs" ]
+            code_dests = [ code_base + variant for variant in code_variants ]
             debug("code:dest:%s" % code_dests)
 
+            html_dests = [dest for dest in code_dests if dest[len(code_base):] in HTML_VARIANTS]
             for dest in code_dests:
+                if dest in html_dests:
+                    continue
                 print '%s -> %s' % (src, dest)
                 success = build_code(src, dest, env, options)
                 if not success:
                     warning('failed')
 
+            if html_dests and not build_html(src, html_dests, env, options):
+                warning('failed')
+
+    if options.package_delta:
+        _log_stage('PACKAGING')
+        if not package_delta(env, options):
+            error('Failed to package')
+            return 1
+
     _log_stage('END')
 
     return 0
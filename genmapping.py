@@ -2,9 +2,14 @@
 # Copyright (c) 2012 Turbulenz Limited
 
 import os
+import mmap
 import base64
+import struct
 import simplejson
 
+from time import time
+from fnmatch import fnmatch
+from random import sample as random_sample
 from logging import getLogger
 from optparse import OptionParser, TitledHelpFormatter
 from hashlib import md5 as hashlib_md5
@@ -12,6 +17,8 @@ from hashlib import md5 as hashlib_md5
 from turbulenz.tools.toolsexception import ToolsException
 from turbulenz.tools.stdtool import simple_options
 
+from mappingpaths import mapping_table_paths
+
 __version__ = '0.1.0'
 __dependencies__ = ['turbulenz.utils.dependencies']
 
@@ -40,10 +47,23 @@ def _parser():
 
     parser.add_option("--ignore-ext", action="append", dest="ignore_exts",
                       default=[], help="extension to be ignored")
+    parser.add_option("--only", action="append", dest="only",
+                      default=[], help="only map assets matching this glob "
+                      "(relative to the asset root)")
 
     parser.add_option("--staticmax-root", action="store", dest="staticmax_root",
                       default="staticmax", help="location of fully static data")
 
+    parser.add_option("--shard", action="store_true", dest="shard",
+                      default=False, help="also write the mapping table sharded by "
+                      "top-level asset directory, plus an index")
+    parser.add_option("--binary", action="store_true", dest="binary",
+                      default=False, help="also write a memory-mappable binary "
+                      "mapping table")
+    parser.add_option("--benchmark", action="store", dest="benchmark", type="int",
+                      default=0, help="benchmark N lookups against the written "
+                      "mapping table formats")
+
     return parser
 
 ############################################################
@@ -57,7 +77,35 @@ def get_target_filename(filename):
 
 ############################################################
 
-def gen_mapping(asset_dir, staticmax_root, ignore=None):
+def _glob_root(pattern):
+    """The leading directories of a glob pattern that contain no wildcards."""
+    root = []
+    for part in pattern.split('/')[:-1]:
+        if any(c in part for c in '*?['):
+            break
+        root.append(part)
+    return '/'.join(root)
+
+def normalise_globs(asset_dir, patterns):
+    """Make globs relative to the asset root, treating a directory as everything below it."""
+    asset_prefix = asset_dir.replace('\\', '/').rstrip('/') + '/'
+    globs = []
+    for pattern in patterns:
+        pattern = pattern.replace('\\', '/')
+        if pattern.startswith(asset_prefix):
+            pattern = pattern[len(asset_prefix):]
+        pattern = pattern.strip('/')
+        if os.path.isdir(os.path.join(asset_dir, pattern)):
+            pattern = pattern + '/*'
+        globs.append(pattern)
+    return globs
+
+def gen_mapping(asset_dir, staticmax_root, ignore=None, only=None, files=None):
+    """Map asset files to their staticmax targets.
+
+    only limits the walk to files matching any of the globs (relative to asset_dir) and files
+    replaces the walk with an explicit list of paths relative to asset_dir.
+    """
 
     def _ext_format(ext):
         if ext[0] == '.':
@@ -74,20 +122,43 @@ def gen_mapping(asset_dir, staticmax_root, ignore=None):
     mapping_table = {}
     build_deps = {}
 
-    for root, dirs, files in os.walk(asset_dir):
-        LOG.info("PATH: %s, dirs: %s, files: %s" % (root, dirs, files))
-
+    if only:
+        only = normalise_globs(asset_dir, only)
+
+    def _walk():
+        if files is not None:
+            for f in files:
+                f_fullpath = os.path.join(asset_dir, f)
+                if os.path.isfile(f_fullpath):
+                    (root, f) = os.path.split(f_fullpath)
+                    yield (root, [f])
+            return
+
+        walk_roots = []
+        for walk_root in sorted(set(_glob_root(pattern) for pattern in only) if only else ['']):
+            if not any(r == '' or walk_root.startswith(r + '/') for r in walk_roots):
+                walk_roots.append(walk_root)
+
+        for walk_root in walk_roots:
+            for root, dirs, walk_files in os.walk(os.path.join(asset_dir, walk_root)):
+                LOG.info("PATH: %s, dirs: %s, files: %s" % (root, dirs, walk_files))
+                yield (root, walk_files)
+
+    for root, root_files in _walk():
         root_rel = os.path.relpath(root, asset_dir)
-        for f in files:
+        for f in root_files:
             f_fullpath = os.path.join(root, f).replace('\\', '/')
             f_path = os.path.join(root_rel, f).replace('\\', '/')
-            f_hash = get_file_hash(f_fullpath)
             f_name, f_ext = os.path.splitext(f)
 
             if f_ext in ignore:
                 continue
             if f_name.startswith('.'):
                 continue
+            if only and not any(fnmatch(os.path.normpath(f_path).replace('\\', '/'), pattern) for pattern in only):
+                continue
+
+            f_hash = get_file_hash(f_fullpath)
 
             target_name = f_hash + f_ext
             if not f_ext in not_json:
@@ -104,6 +175,226 @@ def gen_mapping(asset_dir, staticmax_root, ignore=None):
     mapping_table_object = { "urnmapping" : mapping_table }
     return (mapping_table_object, build_deps)
 
+############################################################
+
+# Binary mapping table layout (all integers little-endian uint32):
+#
+#   header   magic 'TZMT', version, count, num_slots
+#   entries  count * (key_offset, key_length, value_offset, value_length)
+#            sorted by key, offsets relative to the start of the strings
+#   slots    num_slots * (entry index + 1), 0 marks an empty slot.
+#            Open addressing on FNV-1a of the key with linear probing.
+#   strings  utf-8 keys and values, concatenated
+
+MAPPING_BINARY_MAGIC = 'TZMT'
+MAPPING_BINARY_VERSION = 1
+
+_HEADER = struct.Struct('<4sIII')
+_ENTRY = struct.Struct('<IIII')
+_SLOT = struct.Struct('<I')
+
+def _utf8(s):
+    if isinstance(s, unicode):
+        return s.encode('utf-8')
+    return s
+
+def _fnv1a(s):
+    h = 0x811c9dc5
+    for c in s:
+        h = ((h ^ ord(c)) * 0x01000193) & 0xffffffff
+    return h
+
+def _num_slots(count):
+    num_slots = 1
+    while num_slots < count * 2:
+        num_slots <<= 1
+    return num_slots
+
+def shard_name(urn):
+    if '/' in urn:
+        name = urn.split('/', 1)[0]
+        if name not in ('', '.'):
+            return name
+    return '_root'
+
+def shard_mapping(mapping_table):
+    shards = {}
+    for urn, target in mapping_table.iteritems():
+        shards.setdefault(shard_name(urn), {})[urn] = target
+    return shards
+
+def write_binary_mapping(mapping_table, output):
+    items = sorted((_utf8(k), _utf8(v)) for k, v in mapping_table.iteritems())
+    count = len(items)
+    num_slots = _num_slots(count)
+    mask = num_slots - 1
+
+    entries = []
+    strings = []
+    offset = 0
+    for k, v in items:
+        entries.append(_ENTRY.pack(offset, len(k), offset + len(k), len(v)))
+        strings.append(k)
+        strings.append(v)
+        offset += len(k) + len(v)
+
+    slots = [0] * num_slots
+    for i, (k, _) in enumerate(items):
+        slot = _fnv1a(k) & mask
+        while slots[slot]:
+            slot = (slot + 1) & mask
+        slots[slot] = i + 1
+
+    with open(output, 'wb') as f:
+        f.write(_HEADER.pack(MAPPING_BINARY_MAGIC, MAPPING_BINARY_VERSION, count, num_slots))
+        f.write(''.join(entries))
+        f.write(struct.pack('<%dI' % num_slots, *slots))
+        f.write(''.join(strings))
+
+class BinaryMappingTable(object):
+    """Read-only view of a binary mapping table, memory-mapped from disk."""
+
+    def __init__(self, filename):
+        self._file = open(filename, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (magic, version, count, num_slots) = _HEADER.unpack(self._map[:_HEADER.size])
+        if magic != MAPPING_BINARY_MAGIC or version != MAPPING_BINARY_VERSION:
+            self.close()
+            raise ToolsException('Not a binary mapping table (v%d): %s' % (MAPPING_BINARY_VERSION, filename))
+
+        self._count = count
+        self._mask = num_slots - 1
+        self._entries = _HEADER.size
+        self._slots = self._entries + count * _ENTRY.size
+        self._strings = self._slots + num_slots * _SLOT.size
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def _entry(self, index):
+        offset = self._entries + index * _ENTRY.size
+        return _ENTRY.unpack(self._map[offset:offset + _ENTRY.size])
+
+    def _string(self, offset, length):
+        offset += self._strings
+        return self._map[offset:offset + length]
+
+    def get(self, urn, default=None):
+        key = _utf8(urn)
+        slot = _fnv1a(key) & self._mask
+        while True:
+            offset = self._slots + slot * _SLOT.size
+            (index, ) = _SLOT.unpack(self._map[offset:offset + _SLOT.size])
+            if not index:
+                return default
+            (key_offset, key_length, value_offset, value_length) = self._entry(index - 1)
+            if key_length == len(key) and self._string(key_offset, key_length) == key:
+                return self._string(value_offset, value_length)
+            slot = (slot + 1) & self._mask
+
+    def __getitem__(self, urn):
+        value = self.get(urn)
+        if value is None:
+            raise KeyError(urn)
+        return value
+
+    def __contains__(self, urn):
+        return self.get(urn) is not None
+
+    def __len__(self):
+        return self._count
+
+    def iteritems(self):
+        for i in xrange(self._count):
+            (key_offset, key_length, value_offset, value_length) = self._entry(i)
+            yield (self._string(key_offset, key_length), self._string(value_offset, value_length))
+
+def write_mapping_table(mapping_table_object, output, shard=False, binary=False):
+    """Write the flat JSON mapping table and, optionally, the sharded and binary forms alongside it."""
+    paths = mapping_table_paths(output)
+    mapping_table = mapping_table_object['urnmapping']
+
+    with open(output, 'wb') as f:
+        simplejson.dump(mapping_table_object, f, separators=(',', ':'))
+
+    if shard:
+        shards_root = paths['shards']
+        if not os.path.isdir(shards_root):
+            os.makedirs(shards_root)
+        shards_index = {}
+        for name, shard_table in shard_mapping(mapping_table).iteritems():
+            shard_file = os.path.join(shards_root, name + '.json').replace('\\', '/')
+            with open(shard_file, 'wb') as f:
+                simplejson.dump({ "urnmapping" : shard_table }, f, separators=(',', ':'))
+            shards_index[name] = { "file" : os.path.relpath(shard_file, os.path.dirname(output) or '.').replace('\\', '/'),
+                                   "count" : len(shard_table) }
+        with open(paths['index'], 'wb') as f:
+            simplejson.dump({ "version" : 1, "shards" : shards_index }, f, separators=(',', ':'))
+
+    if binary:
+        write_binary_mapping(mapping_table, paths['binary'])
+
+def load_mapping_table(filename):
+    """Load the urnmapping dictionary from a flat, sharded index or binary mapping table."""
+    if filename.endswith('.bin'):
+        table = BinaryMappingTable(filename)
+        try:
+            return dict(table.iteritems())
+        finally:
+            table.close()
+
+    with open(filename, 'rb') as f:
+        obj = simplejson.load(f)
+
+    if 'shards' in obj:
+        root = os.path.dirname(filename)
+        mapping_table = {}
+        for shard in obj['shards'].itervalues():
+            with open(os.path.join(root, shard['file']), 'rb') as f:
+                mapping_table.update(simplejson.load(f)['urnmapping'])
+        return mapping_table
+
+    return obj['urnmapping']
+
+def benchmark_lookup(output, iterations):
+    """Time loading and looking up random URNs in each mapping table format written next to output."""
+    paths = mapping_table_paths(output)
+    mapping_table = load_mapping_table(output)
+    if not mapping_table:
+        LOG.warning('Empty mapping table, nothing to benchmark')
+        return []
+    urns = random_sample(mapping_table.keys(), min(iterations, len(mapping_table)))
+
+    def _json(filename):
+        start = time()
+        table = load_mapping_table(filename)
+        loaded = time()
+        for urn in urns:
+            table[urn]
+        return (loaded - start, time() - loaded)
+
+    def _binary(filename):
+        start = time()
+        table = BinaryMappingTable(filename)
+        loaded = time()
+        for urn in urns:
+            table[urn]
+        end = time()
+        table.close()
+        return (loaded - start, end - loaded)
+
+    results = [('json', _json(output))]
+    if os.path.exists(paths['index']):
+        results.append(('sharded', _json(paths['index'])))
+    if os.path.exists(paths['binary']):
+        results.append(('binary', _binary(paths['binary'])))
+
+    for name, (load_time, lookup_time) in results:
+        print '%-8s load: %8.3fms  %i lookups: %8.3fms' % (name, load_time * 1000, len(urns), lookup_time * 1000)
+    return results
+
 def main():
 
     (options, args, parser) = simple_options(_parser, __version__,
@@ -134,12 +425,16 @@ def main():
 
     (mapping_table_object, build_deps) = gen_mapping(asset_dir,
                                                      staticmax_root,
-                                                     options.ignore_exts)
+                                                     options.ignore_exts,
+                                                     only=options.only)
 
     # Write the output(s)
 
-    with open(options.output, 'wb') as f:
-        simplejson.dump(mapping_table_object, f, separators=(',', ':'))
+    write_mapping_table(mapping_table_object, options.output,
+                        shard=options.shard, binary=options.binary)
+
+    if options.benchmark:
+        benchmark_lookup(options.output, options.benchmark)
 
     if options.depfile:
         with open(options.depfile, 'wb') as f:
@@ -0,0 +1,15 @@
+#!/usr/bin/env python
+# Copyright (c) 2012 Turbulenz Limited
+
+# Kept free of other imports so build.py can find the mapping table files without loading
+# genmapping (and simplejson and the SDK tools it imports).
+
+import os
+
+def mapping_table_paths(output):
+    base, _ = os.path.splitext(output)
+    return {
+        'index': base + '.index.json',
+        'shards': base,
+        'binary': base + '.bin'
+    }